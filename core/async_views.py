@@ -0,0 +1,36 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import close_old_connections
+
+from core.middleware import measure_queries
+from core.views import ProductViewSet, ShoppingCartViewSet
+
+# Django 3.2 has no async ORM: database work runs on this bounded pool, each thread keeping its own connection,
+# while the event loop keeps waiting on slow clients without holding a thread.
+executor = ThreadPoolExecutor(max_workers=settings.ASYNC_DB_THREADS, thread_name_prefix='async-db')
+
+
+def run_in_executor(view):
+    """Turns a sync view into an async view running it, and rendering its response, on the database pool."""
+    def run(request, *args, **kwargs):
+        measure_queries()
+        try:
+            response = view(request, *args, **kwargs)
+            if hasattr(response, 'render') and callable(response.render):
+                response.render()
+            return response
+        finally:
+            close_old_connections()
+
+    async def async_view(request, *args, **kwargs):
+        return await sync_to_async(run, thread_sensitive=False, executor=executor)(request, *args, **kwargs)
+
+    async_view.csrf_exempt = getattr(view, 'csrf_exempt', False)
+    return async_view
+
+
+product_list = run_in_executor(ProductViewSet.as_view({'get': 'list'}))
+product_detail = run_in_executor(ProductViewSet.as_view({'get': 'retrieve'}))
+shopping_cart_list = run_in_executor(ShoppingCartViewSet.as_view({'get': 'list', 'post': 'create'}))
@@ -0,0 +1,187 @@
+import json
+import random
+import subprocess
+import threading
+import time
+from datetime import datetime, timezone
+from decimal import Decimal
+from uuid import uuid4
+
+from django.contrib.auth import get_user_model
+from django.db import connection
+from django.test import Client
+from django.urls import reverse
+from rest_framework_simplejwt.tokens import AccessToken
+
+from core.benchmarks import WORDS
+from core.loadtest import summarize
+from core.models import Order, Product, ShoppingCart, ShoppingProduct
+
+User = get_user_model()
+
+
+class Dataset:
+    """Products, users and carts committed to the database for a suite run, until `delete()` is called.
+
+    Rows are generated from `seed`, so two runs with the same options work on the same data.
+    """
+
+    def __init__(self, products, users, cart_size, seed=0):
+        self.random = random.Random(seed)
+        self.cart_size = cart_size
+        self.tag = f'bench-suite-{uuid4().hex[:8]}'
+        self.product_ids = [product.pk for product in Product.objects.bulk_create(
+            Product(name=f'{WORDS[i % 10]} {WORDS[i // 10 % 10]} {self.tag}-{i}',
+                    price=Decimal(self.random.randint(100, 10000)) / 100, minimum=1, amount_per_package=1,
+                    max_availability=10 ** 12)
+            for i in range(products)
+        )]
+        self.users = self.seed_users(users)
+
+    def seed_users(self, count):
+        """Creates `count` users with a cart of `cart_size` lines, and returns their (token, line ids)."""
+        start = User.objects.filter(username__startswith=f'{self.tag}-').count()
+        users = User.objects.bulk_create(User(username=f'{self.tag}-{i}') for i in range(start, start + count))
+        carts = ShoppingCart.objects.bulk_create(ShoppingCart(user=user) for user in users)
+        lines = ShoppingProduct.objects.bulk_create(
+            ShoppingProduct(shopping_cart=cart, product_id=product_id, quantity=1)
+            for cart in carts for product_id in self.random.sample(self.product_ids, self.cart_size)
+        )
+        ShoppingCart.objects.filter(pk__in=[cart.pk for cart in carts]).refresh_totals()
+        size = self.cart_size
+        return [(str(AccessToken.for_user(user)), [line.pk for line in lines[i * size:(i + 1) * size]])
+                for i, user in enumerate(users)]
+
+    def delete(self):
+        users = User.objects.filter(username__startswith=f'{self.tag}-')
+        ShoppingProduct.objects.filter(product_id__in=self.product_ids).delete()
+        Order.objects.filter(user__in=users).delete()
+        ShoppingCart.objects.filter(user__in=users).delete()
+        users.delete()
+        Product.objects.filter(pk__in=self.product_ids).delete()
+
+
+def search(dataset, requests):
+    url = reverse('products-list')
+    return [(dataset.users[i % len(dataset.users)][0], 'GET',
+             f'{url}?name={WORDS[dataset.random.randrange(10)]}+{WORDS[dataset.random.randrange(10)]}', None)
+            for i in range(requests)]
+
+
+def cart_add(dataset, requests):
+    return [(dataset.users[i % len(dataset.users)][0], 'POST', reverse('shopping-cart-list'),
+             {'product': dataset.random.choice(dataset.product_ids), 'quantity': 1})
+            for i in range(requests)]
+
+
+def cart_patch(dataset, requests):
+    patches = []
+    for i in range(requests):
+        token, line_ids = dataset.users[i % len(dataset.users)]
+        url = reverse('shopping-cart-detail', kwargs={'pk': line_ids[i // len(dataset.users) % len(line_ids)]})
+        patches.append((token, 'PATCH', url, {'quantity': dataset.random.randint(1, 10)}))
+    return patches
+
+
+def cart_list(dataset, requests):
+    return [(dataset.users[i % len(dataset.users)][0], 'GET', reverse('shopping-cart-list'), None)
+            for i in range(requests)]
+
+
+def checkout(dataset, requests):
+    # Every checkout empties a cart, so each request gets a user of its own.
+    return [(token, 'POST', reverse('checkout'), None) for token, _ in dataset.seed_users(requests)]
+
+
+SCENARIOS = {
+    'search': search,
+    'cart-add': cart_add,
+    'cart-patch': cart_patch,
+    'cart-list': cart_list,
+    'checkout': checkout,
+}
+
+
+def run_requests(requests, concurrency):
+    """Sends the (token, method, path, data) requests from `concurrency` threads and returns their statistics."""
+    remaining = iter(requests)
+    lock = threading.Lock()
+    latencies = []
+    statuses = {}
+
+    def client():
+        http = Client(HTTP_HOST='localhost')
+        try:
+            while True:
+                with lock:
+                    request = next(remaining, None)
+                if request is None:
+                    return
+                token, method, path, data = request
+                start = time.perf_counter()
+                response = http.generic(method, path, json.dumps(data) if data is not None else '',
+                                        content_type='application/json', HTTP_AUTHORIZATION=f'Bearer {token}')
+                elapsed = time.perf_counter() - start
+                with lock:
+                    latencies.append(elapsed)
+                    statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+        finally:
+            connection.close()
+
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return summarize(latencies, statuses, time.perf_counter() - start)
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_suite(scenarios=tuple(SCENARIOS), products=1000, users=100, cart_size=5, requests=500, concurrency=10,
+              seed=0):
+    """Seeds a dataset, sends `requests` requests per scenario from `concurrency` threads and returns a report.
+
+    The requests go through the whole Django stack in process, authenticated with access tokens. The seeded rows
+    are deleted once the suite is done.
+    """
+    dataset = Dataset(products, users, cart_size, seed=seed)
+    try:
+        results = {scenario: {'concurrency': concurrency,
+                              **run_requests(SCENARIOS[scenario](dataset, requests), concurrency)}
+                   for scenario in scenarios}
+    finally:
+        dataset.delete()
+    return {
+        'commit': git_commit(),
+        'created_at': datetime.now(timezone.utc).isoformat(),
+        'options': {'products': products, 'users': users, 'cart_size': cart_size, 'requests': requests,
+                    'concurrency': concurrency, 'seed': seed},
+        'scenarios': results,
+    }
+
+
+def compare(baseline, report, threshold=0.2):
+    """Returns the changes from the `baseline` report, and the scenarios whose throughput or p95 latency got worse
+    by more than `threshold`.
+    """
+    changes = {}
+    regressions = []
+    for scenario, result in report['scenarios'].items():
+        if scenario not in baseline['scenarios']:
+            continue
+        before = baseline['scenarios'][scenario]
+        changes[scenario] = {
+            'per_second': round(result['per_second'] / before['per_second'] - 1, 3),
+            'p95_ms': round(result['p95_ms'] / before['p95_ms'] - 1, 3),
+        }
+        if changes[scenario]['per_second'] < -threshold or changes[scenario]['p95_ms'] > threshold:
+            regressions.append(scenario)
+    return changes, regressions
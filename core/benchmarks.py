@@ -0,0 +1,171 @@
+import statistics
+import time
+from decimal import Decimal
+from types import SimpleNamespace
+
+from django.test import override_settings
+from django.urls import reverse
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APIClient, APIRequestFactory, force_authenticate
+from rest_framework_simplejwt.tokens import AccessToken
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import connection, transaction
+
+from core.models import Product, ShoppingCart, ShoppingProduct
+from core.serializers import OrderSerializer, ProductSerializer, ProductValuesSerializer
+from core.views import ProductViewSet, QuoteViewSet
+
+User = get_user_model()
+
+
+class Rollback(Exception):
+    pass
+
+
+class QueryCounter:
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+def seed_cart(username, cart_size):
+    user = User.objects.create(username=username)
+    shopping_cart = ShoppingCart.objects.create(user=user)
+    products = Product.objects.bulk_create(
+        Product(name=f'{username} product {i}', price=Decimal('10.00'), minimum=1, amount_per_package=1,
+                max_availability=1000)
+        for i in range(cart_size)
+    )
+    ShoppingProduct.objects.bulk_create(
+        ShoppingProduct(shopping_cart=shopping_cart, product=product, quantity=2) for product in products
+    )
+    ShoppingCart.objects.filter(pk=shopping_cart.pk).refresh_totals()
+    return user
+
+
+def bench_checkout(cart_size):
+    user = seed_cart(f'benchmark-checkout-{cart_size}', cart_size)
+    request = SimpleNamespace(user=user)
+    queries = QueryCounter()
+    with connection.execute_wrapper(queries):
+        start = time.perf_counter()
+        OrderSerializer().create(request)
+        elapsed = time.perf_counter() - start
+    return elapsed, queries.count
+
+
+WORDS = ['ração', 'cachorro', 'gato', 'areia', 'coleira', 'petisco', 'brinquedo', 'shampoo', 'filhote', 'adulto']
+
+
+def seed_catalog(catalog_size, batch_size=10000):
+    for start in range(0, catalog_size, batch_size):
+        Product.objects.bulk_create(
+            Product(name=f'{WORDS[i % 10]} {WORDS[i // 10 % 10]} {i}', price=Decimal('10.00'), minimum=1,
+                    amount_per_package=1, max_availability=1000)
+            for i in range(start, min(start + batch_size, catalog_size))
+        )
+    with connection.cursor() as cursor:
+        cursor.execute('ANALYZE core_product')
+
+
+def bench_search(catalog_size):
+    seed_catalog(catalog_size)
+    user = User.objects.create(username='benchmark-search')
+    request = APIRequestFactory(HTTP_HOST='localhost').get(reverse('products-list'), {'name': 'cachorro gato 1'})
+    force_authenticate(request, user=user)
+    view = ProductViewSet.as_view({'get': 'list'})
+    queries = QueryCounter()
+    with connection.execute_wrapper(queries):
+        start = time.perf_counter()
+        view(request).render()
+        elapsed = time.perf_counter() - start
+    return elapsed, queries.count
+
+
+def bench_quote(lines):
+    seed_catalog(lines)
+    user = User.objects.create(username='benchmark-quote')
+    product_ids = Product.objects.order_by('-pk').values_list('pk', flat=True)[:lines]
+    request = APIRequestFactory(HTTP_HOST='localhost').post(
+        reverse('quote-list'), {'items': [{'product': pk, 'quantity': 2} for pk in product_ids]}, format='json')
+    force_authenticate(request, user=user)
+    view = QuoteViewSet.as_view({'post': 'create'})
+    queries = QueryCounter()
+    with connection.execute_wrapper(queries):
+        start = time.perf_counter()
+        view(request).render()
+        elapsed = time.perf_counter() - start
+    return elapsed, queries.count
+
+
+def bench_serialize(rows):
+    seed_catalog(rows)
+    queryset = Product.objects.order_by('id')[:rows]
+    start = time.perf_counter()
+    JSONRenderer().render(ProductSerializer(queryset, many=True).data)
+    return time.perf_counter() - start, 1
+
+
+def bench_serialize_values(rows):
+    seed_catalog(rows)
+    queryset = Product.objects.order_by('id').values(*ProductValuesSerializer.lookups())[:rows]
+    start = time.perf_counter()
+    JSONRenderer().render(ProductValuesSerializer.serialize(queryset))
+    return time.perf_counter() - start, 1
+
+
+def bench_auth(requests, cache_ttl=settings.JWT_USER_CACHE_TTL):
+    user = User.objects.create(username='benchmark-auth')
+    product = Product.objects.create(name='benchmark auth', price=Decimal('10.00'), minimum=1, amount_per_package=1,
+                                     max_availability=1000)
+    client = APIClient(HTTP_HOST='localhost')
+    client.credentials(HTTP_AUTHORIZATION=f'Bearer {AccessToken.for_user(user)}')
+    url = reverse('products-detail', kwargs={'pk': product.pk})
+    queries = QueryCounter()
+    with override_settings(JWT_USER_CACHE_TTL=cache_ttl), connection.execute_wrapper(queries):
+        start = time.perf_counter()
+        for _ in range(requests):
+            client.get(url)
+        elapsed = time.perf_counter() - start
+    return elapsed, queries.count
+
+
+def bench_auth_uncached(requests):
+    return bench_auth(requests, cache_ttl=0)
+
+
+SCENARIOS = {
+    'auth': bench_auth,
+    'auth-uncached': bench_auth_uncached,
+    'checkout': bench_checkout,
+    'quote': bench_quote,
+    'search': bench_search,
+    'serialize': bench_serialize,
+    'serialize-values': bench_serialize_values,
+}
+
+
+def run(scenario, size, repeat=5):
+    """Runs a scenario `repeat` times, rolling back every run, and returns its timings."""
+    timings = []
+    queries = 0
+    for _ in range(repeat):
+        try:
+            with transaction.atomic():
+                elapsed, queries = SCENARIOS[scenario](size)
+                raise Rollback
+        except Rollback:
+            timings.append(elapsed)
+    return {
+        'scenario': scenario,
+        'size': size,
+        'queries': queries,
+        'median_ms': round(statistics.median(timings) * 1000, 3),
+        'min_ms': round(min(timings) * 1000, 3),
+        'per_second': round(size / statistics.median(timings)),
+    }
@@ -0,0 +1,164 @@
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+
+from core.models import Product
+
+MISSING = object()
+
+
+class LRUCache:
+    """Thread safe, process local LRU cache whose entries expire `ttl` seconds after being set."""
+
+    def __init__(self, maxsize=1024, ttl=30):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None or item[0] < time.monotonic():
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[1]
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions, 'size': len(self._data)}
+
+
+class ProductCache:
+    """Read-through cache of products and product listings.
+
+    Entries live in a process local LRU in front of the Django cache, and are keyed by a global catalog version
+    kept in the Django cache. Bumping the version invalidates every entry in every process sharing that cache.
+    Entries of a single product are also keyed by a version of that product, so stock changes only invalidate
+    the products they touch; listings keep the availability they were cached with for up to `ttl` seconds.
+    """
+    version_key = 'core:catalog-version'
+    product_version_key = 'core:product-version:{}'
+
+    def __init__(self, maxsize, ttl, alias='default'):
+        self.local = LRUCache(maxsize=maxsize, ttl=ttl)
+        self.ttl = ttl
+        self.alias = alias
+
+    @property
+    def shared(self):
+        return caches[self.alias]
+
+    def version(self):
+        version = self.shared.get(self.version_key)
+        if version is None:
+            # Start from the clock, so a version lost by the cache backend can't come back to a used value.
+            self.shared.add(self.version_key, time.time_ns(), timeout=None)
+            version = self.shared.get(self.version_key)
+        return version
+
+    def product_versions(self, pks):
+        """Returns {pk: version} of the given products."""
+        keys = {self.product_version_key.format(pk): pk for pk in pks}
+        versions = self.shared.get_many(list(keys))
+        for key in keys.keys() - versions.keys():
+            self.shared.add(key, time.time_ns(), timeout=None)
+            versions[key] = self.shared.get(key)
+        return {pk: versions[key] for key, pk in keys.items()}
+
+    def invalidate(self):
+        """Invalidates every cached entry now, and again once the current transaction commits.
+
+        The second bump drops values that concurrent readers cached from the database before the commit.
+        """
+        self._bump([self.version_key])
+        transaction.on_commit(lambda: self._bump([self.version_key]))
+
+    def invalidate_products(self, pks):
+        """Invalidates the cached entries of the given products, like invalidate() does for every entry."""
+        keys = [self.product_version_key.format(pk) for pk in pks]
+        self._bump(keys)
+        transaction.on_commit(lambda: self._bump(keys))
+
+    def _bump(self, keys):
+        for key in keys:
+            try:
+                self.shared.incr(key)
+            except ValueError:
+                self.shared.add(key, time.time_ns(), timeout=None)
+
+    def get(self, key, loader, product=None):
+        """Returns the cached value of `key`, loading it on a miss; `product` is the pk of the product it is about."""
+        version = self.version()
+        if product is not None:
+            version = f'{version}.{self.product_versions([product])[product]}'
+        value = self.local.get((version, key), MISSING)
+        if value is MISSING:
+            value = self.shared.get(f'core:product:{key}', MISSING, version=version)
+            if value is MISSING:
+                value = loader()
+                self.shared.set(f'core:product:{key}', value, self.ttl, version=version)
+            self.local.set((version, key), value)
+        return value
+
+    def get_product(self, pk):
+        """Returns the product with the given pk, or None if it does not exist."""
+        return self.get(f'id:{pk}', lambda: Product.objects.filter(pk=pk).first(), product=pk)
+
+    def get_products(self, pks):
+        """Returns {pk: product} for the given pks that exist, loading every miss with one query."""
+        products = {}
+        missing = []
+        version = self.version()
+        versions = {pk: f'{version}.{product_version}' for pk, product_version in self.product_versions(pks).items()}
+        for pk in pks:
+            product = self.local.get((versions[pk], f'id:{pk}'), MISSING)
+            if product is MISSING:
+                missing.append(pk)
+            elif product is not None:
+                products[pk] = product
+        if missing:
+            loaded = Product.objects.in_bulk(missing)
+            for pk in missing:
+                product = loaded.get(pk)
+                self.local.set((versions[pk], f'id:{pk}'), product)
+                if product is not None:
+                    products[pk] = product
+        return products
+
+    def get_listing(self, key, loader):
+        return self.get(f'listing:{key}', loader)
+
+    def clear(self):
+        self.local.clear()
+        self.invalidate()
+
+    def stats(self):
+        return self.local.stats()
+
+
+product_cache = ProductCache(maxsize=settings.PRODUCT_CACHE_SIZE, ttl=settings.PRODUCT_CACHE_TTL)
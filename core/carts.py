@@ -0,0 +1,86 @@
+import time
+
+from django.db import connection
+
+SWEEP_SQL = '''
+    WITH candidate AS (
+        SELECT id, user_id, total_price, line_count, last_activity
+        FROM core_shoppingcart
+        WHERE id > %(after)s AND last_activity < %(idle_before)s
+        ORDER BY id
+        LIMIT %(limit)s
+        FOR UPDATE SKIP LOCKED
+    ), locked_line AS (
+        SELECT id FROM core_shoppingproduct
+        WHERE shopping_cart_id IN (SELECT id FROM candidate)
+        FOR UPDATE SKIP LOCKED
+    ), idle AS (
+        SELECT * FROM candidate
+        WHERE NOT EXISTS (
+            SELECT 1 FROM core_shoppingproduct
+            WHERE shopping_cart_id = candidate.id AND id NOT IN (SELECT id FROM locked_line)
+        )
+    ), line AS (
+        DELETE FROM core_shoppingproduct
+        WHERE id IN (SELECT id FROM locked_line) AND shopping_cart_id IN (SELECT id FROM idle)
+        RETURNING shopping_cart_id, product_id, quantity
+    ), archived AS (
+        INSERT INTO core_archivedshoppingcart (user_id, total_price, line_count, last_activity, archived_at, lines)
+        SELECT idle.user_id, idle.total_price, idle.line_count, idle.last_activity, now(),
+            COALESCE(cart_line.lines, '[]')
+        FROM idle LEFT JOIN (
+            SELECT shopping_cart_id, json_agg(json_build_object('product', product_id, 'quantity', quantity)
+                                              ORDER BY product_id) AS lines
+            FROM line
+            GROUP BY shopping_cart_id
+        ) cart_line ON cart_line.shopping_cart_id = idle.id
+        WHERE %(archive)s
+    ), cart AS (
+        DELETE FROM core_shoppingcart WHERE id IN (SELECT id FROM idle)
+        RETURNING id
+    )
+    SELECT (SELECT MAX(id) FROM candidate), (SELECT COUNT(*) FROM candidate), (SELECT COUNT(*) FROM cart),
+        (SELECT COUNT(*) FROM line)
+'''
+
+
+def sweep_batch(after, idle_before, limit, archive=False):
+    """Deletes, or archives, up to `limit` carts idle since `idle_before` with an id above `after`, and their lines.
+
+    One statement and transaction per batch. Carts locked by a concurrent change are skipped, they are active. So
+    are carts with a line locked by a concurrent change: cart line updates lock the line before the cart, and
+    waiting for that line while holding the cart could deadlock. Returns the last id and number of carts looked
+    at, and the (carts, lines) deleted.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(SWEEP_SQL, {'after': after, 'idle_before': idle_before, 'limit': limit, 'archive': archive})
+        return cursor.fetchone()
+
+
+def sweep_idle_carts(idle_before, batch_size=1000, archive=False, pause=0.0):
+    """Sweeps the idle carts in id order, `batch_size` at a time with `pause` seconds in between.
+
+    Yields the statistics of every batch and of the whole sweep so far.
+    """
+    after = 0
+    carts = lines = 0
+    start = time.perf_counter()
+    while True:
+        batch_start = time.perf_counter()
+        last_id, scanned, batch_carts, batch_lines = sweep_batch(after, idle_before, batch_size, archive)
+        elapsed = time.perf_counter() - batch_start
+        carts += batch_carts
+        lines += batch_lines
+        total_elapsed = time.perf_counter() - start
+        yield {
+            'carts': batch_carts,
+            'lines': batch_lines,
+            'ms': round(elapsed * 1000, 1),
+            'total_carts': carts,
+            'total_lines': lines,
+            'rows_per_second': round((carts + lines) / total_elapsed) if total_elapsed else 0,
+        }
+        if scanned < batch_size:
+            return
+        after = last_id
+        time.sleep(pause)
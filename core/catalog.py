@@ -0,0 +1,151 @@
+import csv
+import io
+import json
+from itertools import islice
+
+from django.db import connection, transaction
+from rest_framework.exceptions import ValidationError
+
+from core.cache import product_cache
+from core.models import Product
+from core.serializers import ProductImportSerializer, ProductValuesSerializer
+
+FORMATS = ('csv', 'jsonl')
+COLUMNS = ('id', 'name', 'price', 'minimum', 'amount_per_package', 'max_availability')
+
+
+def get_format(name, default='csv'):
+    """Returns the file format of a file name or format parameter."""
+    extension = (name or '').rsplit('.', 1)[-1].lower()
+    return {'csv': 'csv', 'jsonl': 'jsonl', 'ndjson': 'jsonl'}.get(extension, default)
+
+
+def read_rows(stream, file_format):
+    """Yields the rows of a binary CSV or JSON lines stream as dicts, reading it incrementally."""
+    text = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='')
+    if file_format == 'csv':
+        yield from csv.DictReader(text)
+    else:
+        for line in text:
+            if line.strip():
+                yield json.loads(line)
+
+
+def validate(rows, start):
+    """Validates a batch of rows starting at row number `start`, and returns their validated data."""
+    for row in rows:
+        if row.get('id') in ('', None):
+            row.pop('id', None)
+    serializer = ProductImportSerializer(data=rows, many=True)
+    if not serializer.is_valid():
+        raise ValidationError({f'row {start + index}': errors
+                               for index, errors in enumerate(serializer.errors) if errors})
+    return serializer.validated_data
+
+
+def upsert(cursor, products):
+    """COPYs the validated products to the staging table, then inserts or updates them by id.
+
+    Open carts holding a product whose price changes are repriced, and the id sequence is moved past the imported
+    ids. Returns the (created, updated) counts. When a batch repeats an id, its last row wins.
+    """
+    by_id = {}
+    new = []
+    for product in products:
+        if 'id' in product:
+            by_id[product['id']] = product
+        else:
+            new.append(product)
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for product in list(by_id.values()) + new:
+        writer.writerow([product.get('id')] + [product[column] for column in COLUMNS[1:]])
+    buffer.seek(0)
+    cursor.copy_expert(f'COPY core_product_import ({", ".join(COLUMNS)}) FROM STDIN WITH (FORMAT csv)', buffer)
+    # Moves the id sequence past the imported ids, so the ids generated for new products can't take them.
+    cursor.execute('''
+        SELECT setval(sequence, staging.max_id)
+        FROM (SELECT pg_get_serial_sequence(%s, 'id')::regclass AS sequence) serial,
+            (SELECT MAX(id) AS max_id FROM core_product_import) staging
+        WHERE staging.max_id > COALESCE(pg_sequence_last_value(sequence), 0)
+    ''', [Product._meta.db_table])
+    # Reprice the open carts holding updated products, before their price is overwritten.
+    cursor.execute('''
+        UPDATE core_shoppingcart cart SET total_price = cart.total_price + delta.amount
+        FROM (
+            SELECT line.shopping_cart_id, SUM(line.quantity * (staging.price - product.price)) AS amount
+            FROM core_product_import staging
+                JOIN core_product product ON product.id = staging.id
+                JOIN core_shoppingproduct line ON line.product_id = product.id
+            WHERE line.shopping_cart_id IS NOT NULL AND staging.price <> product.price
+            GROUP BY line.shopping_cart_id
+        ) delta
+        WHERE cart.id = delta.shopping_cart_id
+    ''')
+    table = connection.ops.quote_name(Product._meta.db_table)
+    cursor.execute(f'''
+        WITH upserted AS (
+            INSERT INTO {table} ({", ".join(COLUMNS)}, updated_at)
+            SELECT COALESCE(id, nextval(pg_get_serial_sequence(%s, 'id'))), {", ".join(COLUMNS[1:])}, now()
+            FROM core_product_import
+            ON CONFLICT (id) DO UPDATE SET {", ".join(f"{column} = EXCLUDED.{column}" for column in COLUMNS[1:])},
+                updated_at = EXCLUDED.updated_at
+            RETURNING xmax = 0 AS created
+        )
+        SELECT count(*) FILTER (WHERE created), count(*) FILTER (WHERE NOT created) FROM upserted
+    ''', [Product._meta.db_table])
+    created, updated = cursor.fetchone()
+    cursor.execute('TRUNCATE core_product_import')
+    return created, updated
+
+
+@transaction.atomic
+def import_products(stream, file_format='csv', batch_size=5000):
+    """Creates or updates the products of a CSV or JSON lines stream, and returns the (created, updated) counts.
+
+    The stream is parsed and validated with the ProductSerializer rules in batches of `batch_size` rows, so memory
+    does not grow with its size. Rows with an id update that product, and rows without one are created. Nothing
+    is written if any row is invalid.
+    """
+    created = updated = 0
+    rows = read_rows(stream, file_format)
+    table = connection.ops.quote_name(Product._meta.db_table)
+    with connection.cursor() as cursor:
+        cursor.execute(f'CREATE TEMPORARY TABLE core_product_import ON COMMIT DROP AS '
+                       f'SELECT {", ".join(COLUMNS)} FROM {table} WITH NO DATA')
+        start = 1
+        while True:
+            batch = list(islice(rows, batch_size))
+            if not batch:
+                break
+            batch_created, batch_updated = upsert(cursor, validate(batch, start))
+            created += batch_created
+            updated += batch_updated
+            start += len(batch)
+    product_cache.invalidate()
+    return created, updated
+
+
+class Echo:
+    def write(self, value):
+        return value
+
+
+def export_products(file_format='csv', chunk_size=2000):
+    """Yields the whole catalog as CSV or JSON lines, ordered by id, one chunk of `chunk_size` rows at a time.
+
+    Rows are read with a server side cursor and rendered like ProductSerializer, so memory does not grow with the
+    catalog size.
+    """
+    rows = Product.objects.order_by('id').values(*ProductValuesSerializer.lookups()).iterator(chunk_size=chunk_size)
+    writer = csv.writer(Echo())
+    if file_format == 'csv':
+        yield writer.writerow(ProductValuesSerializer.fields)
+    while True:
+        products = ProductValuesSerializer.serialize(islice(rows, chunk_size))
+        if not products:
+            break
+        if file_format == 'csv':
+            yield ''.join(writer.writerow(product.values()) for product in products)
+        else:
+            yield ''.join(json.dumps(product) + '\n' for product in products)
@@ -0,0 +1,90 @@
+import hashlib
+from calendar import timegm
+from functools import wraps
+
+from django.db.models import Count, Max
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag
+from rest_framework.response import Response
+
+
+PAGINATION_PARAMS = ('limit', 'offset', 'cursor', 'pagination')
+
+
+def get_state(queryset, fields):
+    """Returns the (count, timestamps) of a queryset from one aggregate query.
+
+    They change whenever a row is added, removed or updated: COUNT(*) catches removals and MAX() of the `fields`
+    timestamps catches the rest.
+    """
+    aggregates = {f'max_{index}': Max(field) for index, field in enumerate(fields)}
+    # COUNT(*) rather than COUNT(id), so a whole table count can be an index only scan of a timestamp index.
+    values = queryset.aggregate(count=Count('*'), **aggregates)
+    return values['count'], [values[name] for name in aggregates if values[name] is not None]
+
+
+def get_validators(request, state, per_user=True):
+    """Returns the (etag, last modified timestamp) of the requested page of a queryset in the given state."""
+    count, timestamps = state
+    if not timestamps:
+        return None, None
+    version = ':'.join([str(request.user.pk) if per_user else '', request.get_full_path(), str(count)] +
+                       [timestamp.isoformat() for timestamp in timestamps])
+    return quote_etag(hashlib.md5(version.encode()).hexdigest()), timegm(max(timestamps).utctimetuple())
+
+
+def conditional_get(fields=('updated_at',), detail=False, cache=None, per_user=True):
+    """Viewset method decorator answering 304 Not Modified from ETag / Last-Modified validators.
+
+    The validators are computed from the filtered viewset queryset (narrowed to the requested object when
+    `detail`), so a 304 is returned without fetching or serializing rows. `cache` is a ProductCache keeping the
+    queryset state until the catalog (or, for `detail`, the product) changes; it is shared by every page of a
+    listing. Listing pages are then cached too, built after and keyed by the state their ETag comes from.
+
+    The validators are computed per user, unless `per_user` is False for querysets that are the same for every
+    user, which then share them.
+
+    Listings only use the ETag: their newest timestamp stays the same when a row is deleted or when two changes
+    happen within a second, so If-Modified-Since alone would answer a stale 304.
+    """
+    def decorator(view_method):
+        @wraps(view_method)
+        def wrapper(self, request, *args, **kwargs):
+            queryset = self.filter_queryset(self.get_queryset())
+            product = None
+            try:
+                if detail:
+                    lookup_url_kwarg = self.lookup_url_kwarg or self.lookup_field
+                    queryset = queryset.filter(**{self.lookup_field: kwargs[lookup_url_kwarg]})
+                    product = kwargs[lookup_url_kwarg]
+                if cache is not None:
+                    query_params = request.query_params.copy()
+                    for param in PAGINATION_PARAMS:
+                        query_params.pop(param, None)
+                    user = request.user.pk if per_user else ''
+                    key = f'state:{user}:{request.path}?{query_params.urlencode()}'
+                    state = cache.get(key, lambda: get_state(queryset, fields), product=product)
+                else:
+                    state = get_state(queryset, fields)
+            except (TypeError, ValueError):
+                state = (0, [])
+            etag, last_modified = get_validators(request, state, per_user)
+            if not detail:
+                last_modified = None
+            response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+            if response is None:
+                if cache is not None and not detail:
+                    # Pages are cached under their ETag, so each is served with the validators it was built under.
+                    def load():
+                        return view_method(self, request, *args, **kwargs).data
+
+                    response = Response(cache.get_listing(f'{etag}:{request.build_absolute_uri()}', load))
+                else:
+                    response = view_method(self, request, *args, **kwargs)
+                if etag is not None and response.status_code == 200:
+                    response['ETag'] = etag
+                    if last_modified is not None:
+                        response['Last-Modified'] = http_date(last_modified)
+            return response
+        return wrapper
+    return decorator
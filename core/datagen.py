@@ -0,0 +1,179 @@
+import itertools
+import random
+import uuid
+from datetime import timedelta
+from decimal import Decimal
+
+from django.contrib.auth import get_user_model
+from django.core.management.color import no_style
+from django.db import connection, transaction
+from django.utils import timezone
+
+from core import partitions
+from core.benchmarks import WORDS
+from core.cache import product_cache
+from core.models import Order, OrderProduct, Product, ShoppingCart, ShoppingProduct
+
+User = get_user_model()
+
+PACKAGES = (1, 1, 1, 2, 3, 5, 6, 10, 12, 20)
+
+
+class IteratorFile:
+    """Read only file over an iterator of text rows, so COPY streams rows while they are generated."""
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.buffer = ''
+
+    def read(self, size=-1):
+        chunks = [self.buffer]
+        length = len(self.buffer)
+        for row in self.rows:
+            chunks.append(row)
+            length += len(row)
+            if 0 <= size <= length:
+                break
+        data = ''.join(chunks)
+        if size < 0:
+            size = len(data)
+        self.buffer = data[size:]
+        return data[:size]
+
+
+def copy(model, columns, rows):
+    """COPYs the rows, tuples of text values in `columns` order, into the table of `model`."""
+    fields = [model._meta.get_field(column).column for column in columns]
+    with connection.cursor() as cursor:
+        cursor.copy_expert(
+            f'COPY {connection.ops.quote_name(model._meta.db_table)} ({", ".join(fields)}) FROM STDIN',
+            IteratorFile('\t'.join(row) + '\n' for row in rows), 65536,
+        )
+
+
+def next_id(model):
+    return (model.objects.order_by('-pk').values_list('pk', flat=True).first() or 0) + 1
+
+
+class Generator:
+    """Generates deterministic rows for the catalog, users, carts and orders from `seed`.
+
+    Order lines are written with the name and price of their product, like checkout does.
+
+    Product popularity follows a power law: with `skew` above 1, lower product indexes are picked more often. Cart
+    and order sizes are long tailed, averaging about `cart_size` and `order_size` lines.
+    """
+
+    def __init__(self, products, users, carts, orders, cart_size=5, order_size=3, skew=3.0, order_days=365,
+                 seed=0):
+        self.products = products
+        self.users = users
+        self.carts = min(carts, users)
+        self.orders = orders
+        self.cart_size = cart_size
+        self.order_size = order_size
+        self.skew = skew
+        self.order_days = order_days
+        self.seed = seed
+        self.started = timezone.now()
+        self.now = self.started.isoformat()
+        self.product_id = next_id(Product)
+        self.user_id = next_id(User)
+        self.cart_id = next_id(ShoppingCart)
+        self.line_id = next_id(ShoppingProduct)
+
+    def random(self, name):
+        return random.Random(f'{self.seed}:{name}')
+
+    def product(self, index):
+        """Returns the (name, price, package, availability) of a product, a function of its index and the seed."""
+        digest = hash((self.seed, index)) & 0xFFFFFFFFFFFF
+        package = PACKAGES[index % len(PACKAGES)]
+        return (f'{WORDS[digest % 10]} {WORDS[digest // 10 % 10]} {index}', Decimal(100 + digest % 99901) / 100,
+                package, package * (10 + digest // 100000 % 9991))
+
+    def product_rows(self):
+        for i in range(self.products):
+            name, price, package, availability = self.product(i)
+            yield str(self.product_id + i), name, str(price), str(package), str(package), str(availability), self.now
+
+    def user_rows(self):
+        for i in range(self.users):
+            user_id = self.user_id + i
+            yield (str(user_id), '!', f'generated-{user_id}', '', '', '', 'f', 'f', 't', self.now)
+
+    def cart_rows(self):
+        # The first `carts` users own the carts, last active over the last half year. Their totals are computed
+        # once the lines are written.
+        rng = self.random('carts')
+        for i in range(self.carts):
+            last_activity = self.started - timedelta(seconds=rng.randrange(182 * 24 * 3600))
+            yield str(self.cart_id + i), str(self.user_id + i), '0', '0', last_activity.isoformat()
+
+    def pick_lines(self, rng, mean):
+        """Returns the (product index, quantity) lines of a cart or order."""
+        indexes = set()
+        size = min(1 + int(rng.expovariate(1 / mean)), self.products)
+        while len(indexes) < size:
+            indexes.add(int(self.products * rng.random() ** self.skew))
+        return [(index, PACKAGES[index % len(PACKAGES)] * rng.randint(1, 5)) for index in sorted(indexes)]
+
+    def cart_line_rows(self):
+        rng = self.random('cart-lines')
+        line_ids = itertools.count(self.line_id)
+        for i in range(self.carts):
+            for index, quantity in self.pick_lines(rng, self.cart_size):
+                yield (str(next(line_ids)), str(quantity), str(self.product_id + index), str(self.cart_id + i),
+                       self.now)
+
+    def generate_orders(self):
+        """Yields the (id, user id, created at, lines) of the orders, placed over the last `order_days` days."""
+        rng = self.random('orders')
+        for _ in range(self.orders):
+            order_id = uuid.UUID(int=rng.getrandbits(128), version=4)
+            created_at = self.started - timedelta(seconds=rng.randrange(self.order_days * 24 * 3600))
+            yield order_id, self.user_id + rng.randrange(self.users), created_at, self.pick_lines(rng, self.order_size)
+
+    def order_rows(self):
+        for order_id, user_id, created_at, lines in self.generate_orders():
+            total_price = sum(self.product(index)[1] * quantity for index, quantity in lines)
+            yield str(order_id), str(user_id), str(total_price), created_at.isoformat()
+
+    def order_line_rows(self):
+        for order_id, user_id, created_at, lines in self.generate_orders():
+            for index, quantity in lines:
+                name, price, package, availability = self.product(index)
+                yield (str(order_id), str(self.product_id + index), name, str(price), str(quantity),
+                       created_at.isoformat())
+
+    @transaction.atomic
+    def generate(self):
+        """Writes every row with one COPY per table, and returns the number of rows per model."""
+        copy(Product, ('id', 'name', 'price', 'minimum', 'amount_per_package', 'max_availability', 'updated_at'),
+             self.product_rows())
+        copy(User, ('id', 'password', 'username', 'first_name', 'last_name', 'email', 'is_superuser', 'is_staff',
+                    'is_active', 'date_joined'), self.user_rows())
+        copy(ShoppingCart, ('id', 'user', 'total_price', 'line_count', 'last_activity'), self.cart_rows())
+        if self.products:
+            copy(ShoppingProduct, ('id', 'quantity', 'product', 'shopping_cart', 'updated_at'),
+                 self.cart_line_rows())
+            copy(Order, ('id', 'user', 'total_price', 'created_at'), self.order_rows())
+            if partitions.is_partitioned():
+                partitions.create_partitions(self.started - timedelta(days=self.order_days), self.started)
+            copy(OrderProduct, ('order', 'product', 'product_name', 'price', 'quantity', 'created_at'),
+                 self.order_line_rows())
+        ShoppingCart.objects.filter(pk__gte=self.cart_id).refresh_totals()
+        models = [Product, User, ShoppingCart, ShoppingProduct]
+        with connection.cursor() as cursor:
+            for sql in connection.ops.sequence_reset_sql(no_style(), models):
+                cursor.execute(sql)
+            for model in models + [Order, OrderProduct]:
+                cursor.execute(f'ANALYZE {connection.ops.quote_name(model._meta.db_table)}')
+        product_cache.invalidate()
+        return {
+            'products': self.products,
+            'users': self.users,
+            'carts': self.carts,
+            'orders': self.orders if self.products else 0,
+            'cart_lines': next_id(ShoppingProduct) - self.line_id,
+        }
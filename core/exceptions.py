@@ -35,3 +35,9 @@ class ProductQuantityExceeded(APIException):
     status_code = 400
     default_detail = "Product quantity exceed"
     default_code = "product_quantity_exceed"
+
+
+class IdempotencyKeyReused(APIException):
+    status_code = 422
+    default_detail = "Idempotency-Key was already used for another request"
+    default_code = "idempotency_key_reused"
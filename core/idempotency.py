@@ -0,0 +1,69 @@
+import hashlib
+import json
+from datetime import timedelta
+from functools import wraps
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from rest_framework.exceptions import ValidationError
+from rest_framework.response import Response
+
+from core.exceptions import IdempotencyKeyReused
+from core.models import IdempotencyKey
+
+HEADER = 'Idempotency-Key'
+# Response headers stored with the response, and sent again to retries.
+REPLAYED_HEADERS = ('Location',)
+
+
+def get_request_hash(request):
+    body = json.dumps(request.data, sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.sha256(f'{request.method} {request.get_full_path()}\n{body}'.encode()).hexdigest()
+
+
+def idempotent(view_method):
+    """Viewset method decorator answering retries of a request with its stored response.
+
+    Requests sent with an `Idempotency-Key` header run in a transaction holding the lock on the key, and their
+    response is stored with it. Retries with the same key get the stored response without running the view again;
+    retries sent while the first request is still running wait for it. Requests raising an error store nothing, so
+    they can be retried.
+    """
+    @wraps(view_method)
+    def wrapper(self, request, *args, **kwargs):
+        key = request.headers.get(HEADER)
+        if key is None:
+            return view_method(self, request, *args, **kwargs)
+        if not key or len(key) > IdempotencyKey._meta.get_field('key').max_length:
+            raise ValidationError({HEADER: ['Ensure this header has between 1 and 255 characters.']})
+        request_hash = get_request_hash(request)
+        expires_at = timezone.now() + timedelta(seconds=settings.IDEMPOTENCY_KEY_TTL)
+        with transaction.atomic():
+            idempotency_key = IdempotencyKey.objects.claim(request.user, key, request_hash, expires_at)
+            if idempotency_key.request_hash != request_hash:
+                raise IdempotencyKeyReused
+            if idempotency_key.response is not None:
+                stored = idempotency_key.response
+                response = Response(stored['data'], status=stored['status'], headers=stored['headers'])
+                response['Idempotent-Replayed'] = 'true'
+                return response
+            response = view_method(self, request, *args, **kwargs)
+            IdempotencyKey.objects.filter(pk=idempotency_key.pk).update(response={
+                'status': response.status_code,
+                'data': response.data,
+                'headers': {name: response[name] for name in REPLAYED_HEADERS if response.has_header(name)},
+            })
+        return response
+    return wrapper
+
+
+def sweep_expired(batch_size=10000):
+    """Deletes the expired keys, `batch_size` rows per statement, and returns how many were deleted."""
+    deleted = 0
+    while True:
+        expired = IdempotencyKey.objects.filter(expires_at__lt=timezone.now()).values('pk')[:batch_size]
+        count, _ = IdempotencyKey.objects.filter(pk__in=expired).delete()
+        deleted += count
+        if count < batch_size:
+            return deleted
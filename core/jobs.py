@@ -0,0 +1,97 @@
+import threading
+from datetime import timedelta
+from types import SimpleNamespace
+
+from django.db import close_old_connections, connection, transaction
+from django.db.models import F, Q
+from django.db.models.functions import Now
+from django.utils import timezone
+from rest_framework.exceptions import APIException
+
+from core.models import CheckoutJob
+from core.serializers import OrderSerializer
+
+Status = CheckoutJob.Status
+
+
+def claim_jobs(batch_size, lease=60):
+    """Marks up to `batch_size` jobs as running for this worker and returns their (id, attempts).
+
+    Pending jobs are claimed oldest first, with jobs left running longer than `lease` seconds by a dead worker.
+    SELECT ... FOR UPDATE SKIP LOCKED lets concurrent workers claim different jobs without waiting on each other.
+    """
+    expired = timezone.now() - timedelta(seconds=lease)
+    claimable = Q(status=Status.PENDING) | Q(status=Status.RUNNING, started_at__lt=expired)
+    with transaction.atomic():
+        ids = list(CheckoutJob.objects.select_for_update(skip_locked=True).filter(claimable)
+                   .order_by('created_at').values_list('pk', flat=True)[:batch_size])
+        CheckoutJob.objects.filter(pk__in=ids).update(status=Status.RUNNING, started_at=Now(),
+                                                      attempts=F('attempts') + 1)
+        return list(CheckoutJob.objects.filter(pk__in=ids).order_by('created_at').values_list('pk', 'attempts'))
+
+
+def run_job(job_id, attempts, max_attempts=3):
+    """Runs the checkout of a claimed job, and records its order or error in the same transaction.
+
+    Checkouts rejected by the validation fail the job. Unexpected errors put it back in the queue, until it was
+    attempted `max_attempts` times.
+    """
+    try:
+        with transaction.atomic():
+            # The job belongs to this worker as long as nobody claimed it again after its lease expired.
+            job = CheckoutJob.objects.select_for_update().select_related('user') \
+                .filter(pk=job_id, status=Status.RUNNING, attempts=attempts).first()
+            if job is None:
+                return None
+            try:
+                job.order = OrderSerializer().create(SimpleNamespace(user=job.user))
+                job.status = Status.DONE
+            except APIException as exc:
+                job.status = Status.FAILED
+                job.error = str(exc.detail)
+            job.finished_at = timezone.now()
+            job.save(update_fields=['order', 'status', 'error', 'finished_at'])
+            return job.status
+    except Exception as exc:
+        status = Status.FAILED if attempts >= max_attempts else Status.PENDING
+        CheckoutJob.objects.filter(pk=job_id, attempts=attempts).update(status=status, error=repr(exc))
+        return status
+
+
+def process_jobs(batch_size=10, lease=60):
+    """Claims and runs one batch of jobs, and returns how many were claimed."""
+    jobs = claim_jobs(batch_size, lease)
+    for job_id, attempts in jobs:
+        run_job(job_id, attempts)
+    return len(jobs)
+
+
+def run_workers(workers=4, batch_size=10, lease=60, poll_interval=0.5, stop=None, until_empty=False):
+    """Runs `workers` threads processing jobs until `stop` is set, or until the queue is empty with `until_empty`.
+
+    Returns the number of jobs processed.
+    """
+    stop = stop or threading.Event()
+    processed = []
+
+    def worker():
+        count = 0
+        try:
+            while not stop.is_set():
+                close_old_connections()
+                claimed = process_jobs(batch_size, lease)
+                count += claimed
+                if not claimed:
+                    if until_empty:
+                        break
+                    stop.wait(poll_interval)
+        finally:
+            processed.append(count)
+            connection.close()
+
+    threads = [threading.Thread(target=worker) for _ in range(workers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return sum(processed)
@@ -0,0 +1,75 @@
+import asyncio
+import statistics
+import time
+from urllib.parse import urlsplit
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def build_request(url, method='GET', headers=None, body=b''):
+    parts = urlsplit(url)
+    path = parts.path + (f'?{parts.query}' if parts.query else '')
+    lines = [f'{method} {path} HTTP/1.1', f'Host: {parts.netloc}', 'Connection: close',
+             f'Content-Length: {len(body)}']
+    lines += [f'{name}: {value}' for name, value in (headers or {}).items()]
+    return ('\r\n'.join(lines) + '\r\n\r\n').encode() + body
+
+
+async def send(host, port, request):
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        writer.write(request)
+        await writer.drain()
+        status_line = await reader.readline()
+        await reader.read()
+        return int(status_line.split()[1])
+    finally:
+        writer.close()
+
+
+async def run_clients(url, requests, concurrency, request):
+    parts = urlsplit(url)
+    remaining = iter(range(requests))
+    latencies = []
+    statuses = {}
+
+    async def client():
+        for _ in remaining:
+            start = time.perf_counter()
+            try:
+                status = await send(parts.hostname, parts.port or 80, request)
+            except OSError as exc:
+                status = type(exc).__name__
+            latencies.append(time.perf_counter() - start)
+            statuses[status] = statuses.get(status, 0) + 1
+
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    return latencies, statuses
+
+
+def summarize(latencies, statuses, elapsed):
+    """Returns the throughput and latency statistics of requests that took `elapsed` seconds in total."""
+    return {
+        'requests': len(latencies),
+        'statuses': {str(status): count for status, count in statuses.items()},
+        'per_second': round(len(latencies) / elapsed, 1),
+        'mean_ms': round(statistics.mean(latencies) * 1000, 3),
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 3),
+        'p95_ms': round(percentile(latencies, 0.95) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 3),
+    }
+
+
+def run_load(url, requests, concurrency, method='GET', headers=None, body=b''):
+    """Sends `requests` HTTP requests to `url` from `concurrency` concurrent clients and returns their statistics.
+
+    Each request opens its own connection, like a crowd of independent clients.
+    """
+    start = time.perf_counter()
+    latencies, statuses = asyncio.run(run_clients(url, requests, concurrency,
+                                                  build_request(url, method, headers, body)))
+    elapsed = time.perf_counter() - start
+    return {'url': url, 'method': method, 'concurrency': concurrency, **summarize(latencies, statuses, elapsed)}
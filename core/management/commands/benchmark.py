@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from core import benchmarks
+
+
+class Command(BaseCommand):
+    help = 'Runs a benchmark scenario against the configured database. Every run is rolled back.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('scenario', choices=sorted(benchmarks.SCENARIOS))
+        parser.add_argument('--sizes', nargs='+', type=int, default=[10, 100, 1000])
+        parser.add_argument('--repeat', type=int, default=5)
+
+    def handle(self, *args, **options):
+        for size in options['sizes']:
+            result = benchmarks.run(options['scenario'], size, repeat=options['repeat'])
+            self.stdout.write(
+                f"{result['scenario']} size={result['size']} queries={result['queries']} "
+                f"median={result['median_ms']}ms min={result['min_ms']}ms per_second={result['per_second']}"
+            )
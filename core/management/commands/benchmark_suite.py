@@ -0,0 +1,45 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from core import benchmark_suite
+
+
+class Command(BaseCommand):
+    help = ('Seeds products, users and carts, measures throughput and latency percentiles of the main endpoints at '
+            'the given concurrency, and writes a JSON report. The seeded rows are deleted afterwards.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--scenarios', nargs='+', choices=list(benchmark_suite.SCENARIOS),
+                            default=list(benchmark_suite.SCENARIOS))
+        parser.add_argument('--products', type=int, default=1000)
+        parser.add_argument('--users', type=int, default=100)
+        parser.add_argument('--cart-size', type=int, default=5)
+        parser.add_argument('--requests', type=int, default=500, help='Requests per scenario.')
+        parser.add_argument('--concurrency', type=int, default=10)
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--output', help='Writes the report to this file.')
+        parser.add_argument('--compare', help='Compares with a previous report, failing on regressions.')
+        parser.add_argument('--threshold', type=float, default=0.2,
+                            help='Relative throughput drop or p95 latency increase counted as a regression.')
+
+    def handle(self, *args, **options):
+        report = benchmark_suite.run_suite(options['scenarios'], products=options['products'],
+                                           users=options['users'], cart_size=options['cart_size'],
+                                           requests=options['requests'], concurrency=options['concurrency'],
+                                           seed=options['seed'])
+        for scenario, result in report['scenarios'].items():
+            self.stdout.write(
+                f"{scenario} per_second={result['per_second']} p50={result['p50_ms']}ms p95={result['p95_ms']}ms "
+                f"p99={result['p99_ms']}ms statuses={result['statuses']}"
+            )
+        if options['output']:
+            with open(options['output'], 'w') as output:
+                json.dump(report, output, indent=2)
+        if options['compare']:
+            with open(options['compare']) as baseline:
+                changes, regressions = benchmark_suite.compare(json.load(baseline), report, options['threshold'])
+            for scenario, change in changes.items():
+                self.stdout.write(f"{scenario} per_second={change['per_second']:+.1%} p95={change['p95_ms']:+.1%}")
+            if regressions:
+                raise CommandError(f"Performance regressions: {', '.join(regressions)}")
@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+
+from core.models import ShoppingCart
+
+
+class Command(BaseCommand):
+    help = 'Finds shopping carts whose stored totals differ from their lines, and repairs them with --repair.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--repair', action='store_true')
+        parser.add_argument('--batch-size', type=int, default=10000)
+
+    def handle(self, *args, **options):
+        drifted = repaired = 0
+        last_id = ShoppingCart.objects.order_by('-pk').values_list('pk', flat=True).first() or 0
+        for start in range(0, last_id, options['batch_size']):
+            carts = ShoppingCart.objects.filter(pk__gt=start, pk__lte=start + options['batch_size'])
+            ids = list(carts.drifted().values_list('pk', flat=True))
+            drifted += len(ids)
+            if ids and options['repair']:
+                repaired += ShoppingCart.objects.filter(pk__in=ids).refresh_totals()
+        self.stdout.write(f'drifted={drifted} repaired={repaired}')
@@ -0,0 +1,26 @@
+import signal
+import threading
+
+from django.core.management.base import BaseCommand
+
+from core.jobs import run_workers
+
+
+class Command(BaseCommand):
+    help = 'Runs the checkouts queued with POST /checkout/ and the Prefer: respond-async header.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=4, help='Worker threads, each with its own connection.')
+        parser.add_argument('--batch-size', type=int, default=10, help='Jobs claimed at once by a worker.')
+        parser.add_argument('--lease', type=int, default=60,
+                            help='Seconds after which a job left running by a dead worker is claimed again.')
+        parser.add_argument('--poll-interval', type=float, default=0.5)
+        parser.add_argument('--until-empty', action='store_true', help='Stops once the queue is empty.')
+
+    def handle(self, *args, **options):
+        stop = threading.Event()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(signum, lambda *args: stop.set())
+        processed = run_workers(options['workers'], options['batch_size'], options['lease'],
+                                options['poll_interval'], stop=stop, until_empty=options['until_empty'])
+        self.stdout.write(f'processed={processed}')
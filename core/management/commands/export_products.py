@@ -0,0 +1,22 @@
+import sys
+
+from django.core.management.base import BaseCommand
+
+from core.catalog import FORMATS, export_products
+
+
+class Command(BaseCommand):
+    help = 'Writes the whole catalog as CSV or JSON lines, to a file or the standard output.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--format', choices=FORMATS, default='csv')
+        parser.add_argument('--output', help='Defaults to the standard output.')
+
+    def handle(self, *args, **options):
+        output = open(options['output'], 'w', newline='') if options['output'] else sys.stdout
+        try:
+            for chunk in export_products(options['format']):
+                output.write(chunk)
+        finally:
+            if options['output']:
+                output.close()
@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand
+
+from core.datagen import Generator
+
+
+class Command(BaseCommand):
+    help = ('Generates deterministic products, users, shopping carts and orders with Postgres COPY, streaming rows '
+            'as they are generated. Rows are added after the existing ones.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--products', type=int, default=100000)
+        parser.add_argument('--users', type=int, default=10000)
+        parser.add_argument('--carts', type=int, default=5000, help='Users owning a cart, at most --users.')
+        parser.add_argument('--orders', type=int, default=10000)
+        parser.add_argument('--cart-size', type=float, default=5, help='Mean lines per cart.')
+        parser.add_argument('--order-size', type=float, default=3, help='Mean lines per order.')
+        parser.add_argument('--skew', type=float, default=3,
+                            help='Product popularity skew: 1 is uniform, higher values favour fewer products.')
+        parser.add_argument('--order-days', type=int, default=365, help='Orders are placed over the last days.')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        generator = Generator(options['products'], options['users'], options['carts'], options['orders'],
+                              cart_size=options['cart_size'], order_size=options['order_size'],
+                              skew=options['skew'], order_days=options['order_days'], seed=options['seed'])
+        counts = generator.generate()
+        self.stdout.write(' '.join(f'{name}={count}' for name, count in counts.items()))
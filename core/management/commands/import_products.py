@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand, CommandError
+from rest_framework.exceptions import ValidationError
+
+from core.catalog import FORMATS, get_format, import_products
+
+
+class Command(BaseCommand):
+    help = 'Creates or updates products from a CSV or JSON lines file. Rows with an id update that product.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path')
+        parser.add_argument('--format', choices=FORMATS, help='Defaults to the file extension, or csv.')
+        parser.add_argument('--batch-size', type=int, default=5000)
+
+    def handle(self, *args, **options):
+        with open(options['path'], 'rb') as stream:
+            try:
+                created, updated = import_products(stream, options['format'] or get_format(options['path']),
+                                                   batch_size=options['batch_size'])
+            except ValidationError as exc:
+                raise CommandError(f'Invalid rows, nothing was imported: {exc.detail}')
+        self.stdout.write(f'created={created} updated={updated}')
@@ -0,0 +1,28 @@
+import json
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from rest_framework_simplejwt.tokens import AccessToken
+
+from core.loadtest import run_load
+
+
+class Command(BaseCommand):
+    help = 'Sends concurrent HTTP requests to a running server and reports throughput and latency percentiles.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('url')
+        parser.add_argument('--requests', type=int, default=1000)
+        parser.add_argument('--concurrency', type=int, default=100)
+        parser.add_argument('--method', default='GET')
+        parser.add_argument('--data', default='', help='JSON request body.')
+        parser.add_argument('--username', help='Authenticates every request with an access token of this user.')
+
+    def handle(self, *args, **options):
+        headers = {'Content-Type': 'application/json'}
+        if options['username']:
+            user = get_user_model().objects.get(username=options['username'])
+            headers['Authorization'] = f'Bearer {AccessToken.for_user(user)}'
+        result = run_load(options['url'], options['requests'], options['concurrency'], method=options['method'],
+                          headers=headers, body=options['data'].encode())
+        self.stdout.write(json.dumps(result, indent=2))
@@ -0,0 +1,46 @@
+from datetime import datetime, timezone
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from core import partitions
+
+
+def parse_month(value):
+    try:
+        return datetime.strptime(value, '%Y-%m').replace(tzinfo=timezone.utc)
+    except ValueError:
+        raise CommandError(f'Expected a YYYY-MM month, got {value!r}.')
+
+
+class Command(BaseCommand):
+    help = ('Manages the monthly partitions of the order lines: lists them, creates the coming months, or detaches '
+            'or drops the months before --before.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('action', choices=['list', 'create', 'detach', 'drop'])
+        parser.add_argument('--months-ahead', type=int, default=3, help='Months created after the current one.')
+        parser.add_argument('--before', help='YYYY-MM, the first month kept by detach and drop.')
+
+    @transaction.atomic
+    def handle(self, *args, **options):
+        if not partitions.is_partitioned():
+            raise CommandError(f'{partitions.TABLE} is not partitioned, run the migrations first.')
+        if options['action'] == 'list':
+            for name, month, attached in partitions.monthly_partitions():
+                self.stdout.write(f'{name} {"attached" if attached else "detached"}')
+            return
+        if options['action'] == 'create':
+            now = datetime.now(timezone.utc)
+            for name in partitions.create_partitions(now, partitions.add_months(now, options['months_ahead'])):
+                self.stdout.write(f'created {name}')
+            return
+        if options['before'] is None:
+            raise CommandError(f'{options["action"]} needs --before.')
+        for name, attached in partitions.old_partitions(parse_month(options['before'])):
+            if options['action'] == 'detach' and attached:
+                partitions.detach_partition(name)
+                self.stdout.write(f'detached {name}')
+            elif options['action'] == 'drop':
+                partitions.drop_partition(name)
+                self.stdout.write(f'dropped {name}')
@@ -0,0 +1,28 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from core.carts import sweep_idle_carts
+
+
+class Command(BaseCommand):
+    help = 'Deletes the shopping carts, and their lines, left without changes for --idle-days.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--idle-days', type=float, default=settings.CART_IDLE_DAYS)
+        parser.add_argument('--batch-size', type=int, default=1000, help='Carts deleted per transaction.')
+        parser.add_argument('--pause', type=float, default=0.05, help='Seconds to wait between batches.')
+        parser.add_argument('--archive', action='store_true',
+                            help='Copies the carts and their lines to core_archivedshoppingcart before deleting them.')
+
+    def handle(self, *args, **options):
+        idle_before = timezone.now() - timedelta(days=options['idle_days'])
+        stats = {'total_carts': 0, 'total_lines': 0, 'rows_per_second': 0}
+        for batch, stats in enumerate(sweep_idle_carts(idle_before, options['batch_size'], options['archive'],
+                                                       options['pause']), 1):
+            if options['verbosity'] > 1:
+                self.stdout.write(f"batch={batch} carts={stats['carts']} lines={stats['lines']} ms={stats['ms']}")
+        self.stdout.write(f"carts={stats['total_carts']} lines={stats['total_lines']} "
+                          f"rows_per_second={stats['rows_per_second']}")
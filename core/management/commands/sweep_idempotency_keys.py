@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+
+from core.idempotency import sweep_expired
+
+
+class Command(BaseCommand):
+    help = 'Deletes the expired idempotency keys.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=10000, help='Rows deleted per statement.')
+
+    def handle(self, *args, **options):
+        self.stdout.write(f'deleted={sweep_expired(options["batch_size"])}')
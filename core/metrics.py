@@ -0,0 +1,116 @@
+import contextvars
+import threading
+import time
+from bisect import bisect_left
+from functools import wraps
+
+from core.authentication import user_cache
+from core.cache import product_cache
+from marketplace.db.base import pools
+
+TIME_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 200, 500)
+
+HISTOGRAMS = {
+    'request_duration_seconds': ('Total request latency.', TIME_BUCKETS),
+    'db_duration_seconds': ('Time spent running SQL statements.', TIME_BUCKETS),
+    'serialize_duration_seconds': ('Time spent in serializers turning rows into response data.', TIME_BUCKETS),
+    'render_duration_seconds': ('Time spent by the renderer encoding the response data.', TIME_BUCKETS),
+    'db_queries': ('SQL statements run by a request.', QUERY_BUCKETS),
+}
+
+
+class SerializeTimer:
+    def __init__(self):
+        self.duration = 0
+        self.depth = 0
+
+
+# Timer of the sampled request being handled, None for requests that are not measured.
+serialize_timer = contextvars.ContextVar('serialize_timer', default=None)
+
+
+def timed_representation(to_representation):
+    """Adds the time spent in `to_representation` to the serialize time of the sampled request.
+
+    Only the outermost call is timed, so nested and list serializers are counted once.
+    """
+    @wraps(to_representation)
+    def wrapper(*args, **kwargs):
+        timer = serialize_timer.get()
+        if timer is None or timer.depth:
+            return to_representation(*args, **kwargs)
+        timer.depth += 1
+        start = time.perf_counter()
+        try:
+            return to_representation(*args, **kwargs)
+        finally:
+            timer.duration += time.perf_counter() - start
+            timer.depth -= 1
+    return wrapper
+
+
+class TimedSerializerMixin:
+    @timed_representation
+    def to_representation(self, instance):
+        return super().to_representation(instance)
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        index = bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            self.counts[index] += 1
+        self.sum += value
+        self.count += 1
+
+
+class RequestMetrics:
+    """Process local histograms of the sampled requests, by route name."""
+
+    def __init__(self, prefix='marketplace'):
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self._histograms = {name: {} for name in HISTOGRAMS}
+
+    def observe(self, route, **values):
+        with self._lock:
+            for name, value in values.items():
+                histograms = self._histograms[name]
+                if route not in histograms:
+                    histograms[route] = Histogram(HISTOGRAMS[name][1])
+                histograms[route].observe(value)
+
+    def render(self):
+        """Returns the histograms, cache and connection pool counters in Prometheus text format."""
+        lines = []
+        with self._lock:
+            for name, (description, buckets) in HISTOGRAMS.items():
+                metric = f'{self.prefix}_{name}'
+                lines += [f'# HELP {metric} {description}', f'# TYPE {metric} histogram']
+                for route, histogram in sorted(self._histograms[name].items()):
+                    cumulative = 0
+                    for bucket, count in zip(buckets, histogram.counts):
+                        cumulative += count
+                        lines.append(f'{metric}_bucket{{route="{route}",le="{bucket}"}} {cumulative}')
+                    lines.append(f'{metric}_bucket{{route="{route}",le="+Inf"}} {histogram.count}')
+                    lines.append(f'{metric}_sum{{route="{route}"}} {histogram.sum}')
+                    lines.append(f'{metric}_count{{route="{route}"}} {histogram.count}')
+        for cache_name, cache in (('product_cache', product_cache), ('jwt_user_cache', user_cache)):
+            for name, value in cache.stats().items():
+                metric = f'{self.prefix}_{cache_name}_{name}'
+                lines += [f'# TYPE {metric} {"gauge" if name == "size" else "counter"}', f'{metric} {value}']
+        for (alias, host, port, database), pool in pools.items():
+            for name, value in pool.stats().items():
+                metric = f'{self.prefix}_db_pool_{name}'
+                lines.append(f'{metric}{{alias="{alias}",database="{database}"}} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+request_metrics = RequestMetrics()
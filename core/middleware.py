@@ -0,0 +1,110 @@
+import asyncio
+import contextvars
+import random
+import time
+
+from django.conf import settings
+from django.db import connection
+from django.utils.deprecation import MiddlewareMixin
+
+from core.metrics import SerializeTimer, request_metrics, serialize_timer
+
+
+class QueryTimer:
+    def __init__(self):
+        self.count = 0
+        self.duration = 0
+        self.measured = False
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.duration += time.perf_counter() - start
+            self.count += 1
+
+
+# Timer of the sampled request being handled, None for requests that are not measured.
+query_timer = contextvars.ContextVar('query_timer', default=None)
+
+
+def time_query(execute, sql, params, many, context):
+    timer = query_timer.get()
+    if timer is None:
+        return execute(sql, params, many, context)
+    return timer(execute, sql, params, many, context)
+
+
+def measure_queries():
+    """Reports the queries of this thread's connection to the timer of the sampled request being handled.
+
+    To be called from the thread running the view: under ASGI, sync views and the async views' database work run
+    on other threads than the middleware, with connections of their own.
+    """
+    timer = query_timer.get()
+    if timer is not None:
+        if time_query not in connection.execute_wrappers:
+            connection.execute_wrappers.append(time_query)
+        timer.measured = True
+
+
+class RequestMetricsMiddleware(MiddlewareMixin):
+    """Measures a sample of the requests: SQL statements, database time, serialize and render time and total latency.
+
+    Sampled responses get a Server-Timing header, and the measures are aggregated per route name in
+    core.metrics.request_metrics. The middleware runs natively under ASGI, without putting async requests through
+    a thread. Database measures are left out of requests whose view did not call measure_queries(), e.g. requests
+    answered before reaching a view.
+    """
+
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self.get_response):
+            return self.__acall__(request)
+        if random.random() >= settings.REQUEST_METRICS_SAMPLE_RATE:
+            return self.get_response(request)
+        measure = self.start(request)
+        response = self.get_response(request)
+        return self.finish(request, response, *measure)
+
+    async def __acall__(self, request):
+        if random.random() >= settings.REQUEST_METRICS_SAMPLE_RATE:
+            return await self.get_response(request)
+        measure = self.start(request)
+        response = await self.get_response(request)
+        return self.finish(request, response, *measure)
+
+    def start(self, request):
+        request.render_duration = 0
+        queries, serialize = QueryTimer(), SerializeTimer()
+        return queries, serialize, query_timer.set(queries), serialize_timer.set(serialize), time.perf_counter()
+
+    def finish(self, request, response, queries, serialize, query_token, serialize_token, start):
+        duration = time.perf_counter() - start
+        query_timer.reset(query_token)
+        serialize_timer.reset(serialize_token)
+        route = request.resolver_match.url_name if request.resolver_match else 'unmatched'
+        values = {'request_duration_seconds': duration, 'serialize_duration_seconds': serialize.duration,
+                  'render_duration_seconds': request.render_duration}
+        timings = [f'serialize;dur={serialize.duration * 1000:.3f}',
+                   f'render;dur={request.render_duration * 1000:.3f}', f'total;dur={duration * 1000:.3f}']
+        if queries.measured:
+            values.update(db_duration_seconds=queries.duration, db_queries=queries.count)
+            timings.insert(0, f'db;dur={queries.duration * 1000:.3f};desc="{queries.count} queries"')
+        request_metrics.observe(route, **values)
+        response['Server-Timing'] = ', '.join(timings)
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        # Runs on the thread of sync views, under ASGI too. Async views measure their own database threads.
+        if not asyncio.iscoroutinefunction(view_func):
+            measure_queries()
+
+    def process_template_response(self, request, response):
+        if hasattr(request, 'render_duration'):
+            start = time.perf_counter()
+
+            def rendered(response):
+                request.render_duration = time.perf_counter() - start
+            response.add_post_render_callback(rendered)
+        return response
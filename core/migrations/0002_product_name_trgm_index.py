@@ -0,0 +1,23 @@
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+    # CREATE INDEX CONCURRENTLY can not run inside a transaction, and keeps the catalog writable while it builds.
+    atomic = False
+
+    dependencies = [
+        ('core', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            sql='CREATE EXTENSION IF NOT EXISTS pg_trgm',
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+        # Matches the expression Django compiles name__icontains to: UPPER("name"::text) LIKE UPPER('%term%').
+        migrations.RunSQL(
+            sql='CREATE INDEX CONCURRENTLY IF NOT EXISTS core_product_name_trgm '
+                'ON core_product USING gin (UPPER(name::text) gin_trgm_ops)',
+            reverse_sql='DROP INDEX CONCURRENTLY IF EXISTS core_product_name_trgm',
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 3.2.8 on 2026-10-18 21:13
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0002_product_name_trgm_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True, db_index=True),
+        ),
+        migrations.AddField(
+            model_name='shoppingproduct',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True),
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 3.2.8 on 2026-10-18 21:38
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0003_updated_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='shoppingcart',
+            name='line_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='shoppingcart',
+            name='total_price',
+            field=models.DecimalField(decimal_places=2, default=0, max_digits=1000),
+        ),
+        migrations.RunSQL(
+            sql='''
+                UPDATE core_shoppingcart cart
+                SET total_price = line.total_price, line_count = line.line_count
+                FROM (
+                    SELECT shopping_cart_id, SUM(quantity * product.price) AS total_price, COUNT(*) AS line_count
+                    FROM core_shoppingproduct JOIN core_product product ON product.id = product_id
+                    WHERE shopping_cart_id IS NOT NULL
+                    GROUP BY shopping_cart_id
+                ) line
+                WHERE cart.id = line.shopping_cart_id
+            ''',
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+    ]
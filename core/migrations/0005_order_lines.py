@@ -0,0 +1,75 @@
+# Generated by Django 3.2.8 on 2026-10-18 22:02
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('core', '0004_cart_totals'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='created_at',
+            field=models.DateTimeField(auto_now_add=True, default=django.utils.timezone.now),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='total_price',
+            field=models.DecimalField(decimal_places=2, default=0, max_digits=1000),
+        ),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['user', 'created_at'], name='core_order_user_created_idx'),
+        ),
+        migrations.CreateModel(
+            name='OrderProduct',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('product_name', models.CharField(max_length=512)),
+                ('price', models.DecimalField(decimal_places=2, max_digits=1000)),
+                ('quantity', models.BigIntegerField()),
+                ('order', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='lines', to='core.order')),
+                ('product', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='order_products', to='core.product')),
+            ],
+        ),
+        # Move the lines of past orders out of the cart table. Their price is the current product price, the
+        # closest to the price they were sold at that is left, and the order date is the time of checkout.
+        migrations.RunSQL(
+            sql=[
+                '''
+                INSERT INTO core_orderproduct (order_id, product_id, product_name, price, quantity)
+                SELECT line.order_id, product.id, product.name, product.price, line.quantity
+                FROM core_shoppingproduct line JOIN core_product product ON product.id = line.product_id
+                WHERE line.order_id IS NOT NULL
+                ORDER BY line.id
+                ''',
+                '''
+                UPDATE core_order SET total_price = line.total_price, created_at = line.created_at
+                FROM (
+                    SELECT order_product.order_id, SUM(order_product.price * order_product.quantity) AS total_price,
+                        MAX(shopping_product.updated_at) AS created_at
+                    FROM core_orderproduct order_product
+                        JOIN core_shoppingproduct shopping_product
+                        ON shopping_product.order_id = order_product.order_id
+                            AND shopping_product.product_id = order_product.product_id
+                    GROUP BY order_product.order_id
+                ) line
+                WHERE core_order.id = line.order_id
+                ''',
+                'DELETE FROM core_shoppingproduct WHERE order_id IS NOT NULL',
+            ],
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+        migrations.RemoveField(
+            model_name='shoppingproduct',
+            name='order',
+        ),
+    ]
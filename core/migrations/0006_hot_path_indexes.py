@@ -0,0 +1,34 @@
+# Generated by Django 3.2.8 on 2026-10-18 21:47
+
+from django.conf import settings
+from django.contrib.postgres.operations import AddIndexConcurrently
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('core', '0005_order_lines'),
+    ]
+
+    # Build the new index without blocking writes, before dropping the foreign key indexes it makes redundant.
+    atomic = False
+
+    operations = [
+        AddIndexConcurrently(
+            model_name='shoppingproduct',
+            index=models.Index(condition=models.Q(('shopping_cart__isnull', False)), fields=['shopping_cart'], include=('product', 'quantity'), name='core_shoppingproduct_cart_idx'),
+        ),
+        migrations.AlterField(
+            model_name='order',
+            name='user',
+            field=models.ForeignKey(blank=True, db_index=False, on_delete=django.db.models.deletion.PROTECT, related_name='user_order', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AlterField(
+            model_name='shoppingproduct',
+            name='shopping_cart',
+            field=models.ForeignKey(blank=True, db_index=False, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='shopping_cart', to='core.shoppingcart'),
+        ),
+    ]
@@ -0,0 +1,48 @@
+# Generated by Django 3.2.8 on 2026-10-18 22:00
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('core', '0008_idempotency_keys'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='shoppingcart',
+            name='last_activity',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        # Existing carts were last active when one of their lines last changed.
+        migrations.RunSQL(
+            sql='''
+                UPDATE core_shoppingcart cart SET last_activity = line.updated_at
+                FROM (
+                    SELECT shopping_cart_id, MAX(updated_at) AS updated_at
+                    FROM core_shoppingproduct
+                    WHERE shopping_cart_id IS NOT NULL
+                    GROUP BY shopping_cart_id
+                ) line
+                WHERE cart.id = line.shopping_cart_id
+            ''',
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+        migrations.CreateModel(
+            name='ArchivedShoppingCart',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('total_price', models.DecimalField(decimal_places=2, max_digits=1000)),
+                ('line_count', models.IntegerField()),
+                ('last_activity', models.DateTimeField()),
+                ('archived_at', models.DateTimeField(auto_now_add=True)),
+                ('lines', models.JSONField()),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='archived_carts', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+    ]
@@ -0,0 +1,36 @@
+from django.db import migrations, models
+import django.utils.timezone
+
+
+def partition_order_lines(apps, schema_editor):
+    from core.partitions import partition_order_lines
+    partition_order_lines(months_ahead=3)
+
+
+def unpartition_order_lines(apps, schema_editor):
+    from core.partitions import unpartition_order_lines
+    unpartition_order_lines()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0009_cart_expiry'),
+    ]
+
+    operations = [
+        # The lines are copied to a new table partitioned by month of created_at, filled from their order.
+        migrations.SeparateDatabaseAndState(
+            state_operations=[
+                migrations.AddField(
+                    model_name='orderproduct',
+                    name='created_at',
+                    field=models.DateTimeField(default=django.utils.timezone.now),
+                    preserve_default=False,
+                ),
+            ],
+            database_operations=[
+                migrations.RunPython(partition_order_lines, unpartition_order_lines),
+            ],
+        ),
+    ]
@@ -1,7 +1,14 @@
+import json
 import uuid
 
 from django.contrib.auth.models import User
-from django.db import models
+from decimal import Decimal
+
+from django.db import connection, models, transaction
+from django.db.models import Count, DecimalField, F, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce, Now
+from django.utils import timezone
+from rest_framework.utils.encoders import JSONEncoder
 
 
 # Create your models here.
@@ -13,29 +20,335 @@ class Product(models.Model):
     minimum = models.IntegerField()
     amount_per_package = models.IntegerField(verbose_name='amount-per-package')
     max_availability = models.BigIntegerField(verbose_name='max-availability')
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
+
+    @transaction.atomic(savepoint=False)
+    def save(self, *args, **kwargs):
+        update_fields = kwargs.get('update_fields')
+        if self._state.adding or (update_fields is not None and 'price' not in update_fields):
+            return super().save(*args, **kwargs)
+        # Locks the open carts holding this product, then the product, in the order checkout locks them, and
+        # reprices the carts by the difference with the price stored before this save.
+        carts = list(ShoppingCart.objects.select_for_update(of=('self',)).filter(shopping_cart__product=self)
+                     .order_by('pk').values_list('pk', flat=True))
+        stored_price = Product.objects.select_for_update(no_key=True).filter(pk=self.pk) \
+            .values_list('price', flat=True).first()
+        super().save(*args, **kwargs)
+        if carts and stored_price is not None and Decimal(self.price) != stored_price:
+            quantity = ShoppingProduct.objects.filter(shopping_cart=OuterRef('pk'), product=self) \
+                .values('quantity')[:1]
+            ShoppingCart.objects.filter(pk__in=carts).update(
+                total_price=F('total_price') + Subquery(quantity) * (Decimal(self.price) - stored_price))
 
     def __str__(self):
         return f'{self.name}'
 
 
+class ShoppingCartQuerySet(models.QuerySet):
+    def adjust(self, total_price, line_count=0):
+        """Adds to the stored totals of the carts, after a change of their lines, and marks them as active."""
+        return self.update(total_price=F('total_price') + total_price, line_count=F('line_count') + line_count,
+                           last_activity=Now())
+
+    def with_line_totals(self):
+        """Annotates the totals recomputed from the cart lines, as `line_total_price` and `line_total_count`."""
+        lines = ShoppingProduct.objects.filter(shopping_cart=OuterRef('pk')).order_by().values('shopping_cart')
+        total_price = lines.annotate(total=Sum(F('quantity') * F('product__price'))).values('total')
+        line_count = lines.annotate(count=Count('pk')).values('count')
+        price_field = DecimalField(max_digits=1000, decimal_places=2)
+        return self.annotate(
+            line_total_price=Coalesce(Subquery(total_price, output_field=price_field), Value(0),
+                                      output_field=price_field),
+            line_total_count=Coalesce(Subquery(line_count), Value(0)),
+        )
+
+    def drifted(self):
+        """Carts whose stored totals differ from their lines."""
+        return self.with_line_totals().exclude(total_price=F('line_total_price'), line_count=F('line_total_count'))
+
+    def refresh_totals(self):
+        """Recomputes the stored totals of the carts from their lines."""
+        totals = ShoppingCart.objects.with_line_totals().filter(pk=OuterRef('pk'))
+        return self.update(total_price=Subquery(totals.values('line_total_price')),
+                           line_count=Subquery(totals.values('line_total_count')))
+
+
 class ShoppingCart(models.Model):
+    """The open cart of a user.
+
+    `total_price` and `line_count` are stored, and kept up to date in the transaction changing a cart line or a
+    product price. The check_cart_totals command finds and repairs carts that drifted from their lines.
+
+    `last_activity` is the time the lines last changed. The sweep_carts command deletes carts idle for too long.
+    """
     user = models.OneToOneField(User, related_name='user_cart', blank=True, on_delete=models.PROTECT, unique=True)
+    total_price = models.DecimalField(max_digits=1000, decimal_places=2, default=0)
+    line_count = models.IntegerField(default=0)
+    # Not indexed: it changes with every cart change, and the sweeper walks the carts in id order instead.
+    last_activity = models.DateTimeField(default=timezone.now)
+
+    objects = ShoppingCartQuerySet.as_manager()
 
     def __str__(self):
         return f'{self.user}'
 
 
+class ArchivedShoppingCart(models.Model):
+    """A cart deleted by `sweep_carts --archive`, with its lines as [{"product": id, "quantity": n}]."""
+    user = models.ForeignKey(User, related_name='archived_carts', on_delete=models.CASCADE)
+    total_price = models.DecimalField(max_digits=1000, decimal_places=2)
+    line_count = models.IntegerField()
+    last_activity = models.DateTimeField()
+    archived_at = models.DateTimeField(auto_now_add=True)
+    lines = models.JSONField()
+
+
+class OrderManager(models.Manager):
+    def create_from_cart(self, user):
+        """Creates an order from the cart lines of the user, with one statement.
+
+        Every order line keeps the product name and price at checkout time, and the order keeps their total.
+        """
+        order = self.model(user=user)
+        with connection.cursor() as cursor:
+            cursor.execute('''
+                WITH cart_line AS (
+                    SELECT line.id, line.quantity, product.id AS product_id, product.name, product.price
+                    FROM core_shoppingproduct line
+                        JOIN core_shoppingcart cart ON cart.id = line.shopping_cart_id
+                        JOIN core_product product ON product.id = line.product_id
+                    WHERE cart.user_id = %s
+                ), new_order AS (
+                    INSERT INTO core_order (id, user_id, total_price, created_at)
+                    SELECT %s, %s, COALESCE(SUM(price * quantity), 0), now() FROM cart_line
+                    RETURNING id, total_price, created_at
+                ), order_line AS (
+                    INSERT INTO core_orderproduct (order_id, product_id, product_name, price, quantity, created_at)
+                    SELECT new_order.id, cart_line.product_id, cart_line.name, cart_line.price, cart_line.quantity,
+                        new_order.created_at
+                    FROM new_order, cart_line
+                    ORDER BY cart_line.id
+                )
+                SELECT total_price, created_at FROM new_order
+            ''', [user.pk, order.pk, user.pk])
+            order.total_price, order.created_at = cursor.fetchone()
+        order._state.adding = False
+        return order
+
+    def prefetch_lines(self, orders):
+        """Loads the lines of the orders with one query, which only reads the partitions of their months."""
+        orders = [order for order in orders if order is not None]
+        if orders:
+            created_at = [order.created_at for order in orders]
+            lines = OrderProduct.objects.filter(created_at__gte=min(created_at), created_at__lte=max(created_at))
+            models.prefetch_related_objects(orders, models.Prefetch('lines', queryset=lines))
+        return orders
+
+
 class Order(models.Model):
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
-    user = models.ForeignKey(User, related_name='user_order', blank=True, on_delete=models.PROTECT)
+    # Indexed by core_order_user_created_idx.
+    user = models.ForeignKey(User, related_name='user_order', blank=True, on_delete=models.PROTECT, db_index=False)
+    total_price = models.DecimalField(max_digits=1000, decimal_places=2, default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    objects = OrderManager()
+
+    class Meta:
+        indexes = [models.Index(fields=['user', 'created_at'], name='core_order_user_created_idx')]
+
+
+class OrderProduct(models.Model):
+    """Immutable line of an order, keeping the product as it was sold."""
+    order = models.ForeignKey(Order, related_name='lines', on_delete=models.CASCADE)
+    product = models.ForeignKey(Product, related_name='order_products', null=True, on_delete=models.SET_NULL)
+    product_name = models.CharField(max_length=512)
+    price = models.DecimalField(max_digits=1000, decimal_places=2)
+    quantity = models.BigIntegerField()
+    # The time of the order. The table is partitioned by its month, see core.partitions.
+    created_at = models.DateTimeField()
+
+    @property
+    def partial_price(self):
+        return self.price * self.quantity
+
+
+class CheckoutJob(models.Model):
+    """Checkout queued by POST /checkout/ with `Prefer: respond-async`, run by the checkout_worker command."""
+
+    class Status(models.TextChoices):
+        PENDING = 'pending'
+        RUNNING = 'running'
+        DONE = 'done'
+        FAILED = 'failed'
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    user = models.ForeignKey(User, related_name='checkout_jobs', on_delete=models.PROTECT)
+    status = models.CharField(max_length=16, choices=Status.choices, default=Status.PENDING)
+    order = models.ForeignKey(Order, related_name='checkout_jobs', null=True, blank=True, on_delete=models.SET_NULL)
+    error = models.TextField(blank=True)
+    attempts = models.IntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            # The queue: jobs to claim, oldest first.
+            models.Index(fields=['created_at'], condition=models.Q(status__in=['pending', 'running']),
+                         name='core_checkoutjob_queue_idx'),
+        ]
+
+
+class IdempotencyKeyManager(models.Manager):
+    def claim(self, user, key, request_hash, expires_at):
+        """Returns the key of the user, inserted unless it exists, and locked until the end of the transaction.
+
+        A concurrent request with the same key waits on the insert until the first one commits, then gets the key
+        with its stored response. An expired key starts over with the new request.
+        """
+        with connection.cursor() as cursor:
+            cursor.execute('''
+                INSERT INTO core_idempotencykey AS stored (user_id, key, request_hash, created_at, expires_at)
+                VALUES (%s, %s, %s, now(), %s)
+                ON CONFLICT (user_id, key) DO UPDATE SET
+                    request_hash = CASE WHEN stored.expires_at < now() THEN excluded.request_hash
+                        ELSE stored.request_hash END,
+                    response = CASE WHEN stored.expires_at < now() THEN NULL ELSE stored.response END,
+                    created_at = CASE WHEN stored.expires_at < now() THEN excluded.created_at
+                        ELSE stored.created_at END,
+                    expires_at = CASE WHEN stored.expires_at < now() THEN excluded.expires_at
+                        ELSE stored.expires_at END
+                RETURNING id, request_hash, response, created_at, expires_at
+            ''', [user.pk, key, request_hash, expires_at])
+            pk, request_hash, response, created_at, expires_at = cursor.fetchone()
+        if isinstance(response, str):
+            response = json.loads(response)
+        idempotency_key = self.model(pk=pk, user=user, key=key, request_hash=request_hash, response=response,
+                                     created_at=created_at, expires_at=expires_at)
+        idempotency_key._state.adding = False
+        return idempotency_key
+
+
+class IdempotencyKey(models.Model):
+    """Response of a request sent with an `Idempotency-Key` header, replayed to retries of the request."""
+    user = models.ForeignKey(User, related_name='idempotency_keys', on_delete=models.CASCADE, db_index=False)
+    key = models.CharField(max_length=255)
+    # SHA-256 of the method, path and body, so a key reused for another request is rejected.
+    request_hash = models.CharField(max_length=64)
+    # The status, data and replayed headers; NULL while the first request is running.
+    response = models.JSONField(null=True, encoder=JSONEncoder)
+    created_at = models.DateTimeField(auto_now_add=True)
+    expires_at = models.DateTimeField(db_index=True)
+
+    objects = IdempotencyKeyManager()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'key'], name='core_idempotencykey_user_key_uniq'),
+        ]
+
+
+class ShoppingProductManager(models.Manager):
+    @transaction.atomic(savepoint=False)
+    def add_to_cart(self, user_id, quantities):
+        """Adds {product_id: quantity} to the user cart, creating the cart and lines as needed.
+
+        The lines are written by one statement: existing lines are incremented in the database, and a line is only
+        written if its resulting quantity is within the product availability and a multiple of its package. A
+        second statement adds them to the cart totals. Returns the written lines with their product loaded; lines
+        that were rejected are missing.
+        """
+        items = list(quantities.items())
+        values = ', '.join(['(%s::bigint, %s::bigint)'] * len(items))
+        params = [user_id] + [value for item in items for value in item]
+        with connection.cursor() as cursor:
+            cursor.execute(f'''
+                WITH cart AS (
+                    INSERT INTO core_shoppingcart (user_id, total_price, line_count, last_activity)
+                    VALUES (%s, 0, 0, now())
+                    ON CONFLICT (user_id) DO UPDATE SET user_id = EXCLUDED.user_id
+                    RETURNING id
+                ), item (product_id, quantity) AS (
+                    VALUES {values}
+                ), line AS (
+                    INSERT INTO core_shoppingproduct (shopping_cart_id, product_id, quantity, updated_at)
+                    SELECT cart.id, product.id, item.quantity, now()
+                    FROM cart, item JOIN core_product product ON product.id = item.product_id
+                    WHERE item.quantity <= product.max_availability
+                        AND item.quantity %% product.amount_per_package = 0
+                    ON CONFLICT (shopping_cart_id, product_id)
+                    DO UPDATE SET quantity = core_shoppingproduct.quantity + EXCLUDED.quantity, updated_at = now()
+                    WHERE core_shoppingproduct.quantity + EXCLUDED.quantity <= (
+                            SELECT max_availability FROM core_product WHERE id = EXCLUDED.product_id)
+                        AND (core_shoppingproduct.quantity + EXCLUDED.quantity) %% (
+                            SELECT amount_per_package FROM core_product WHERE id = EXCLUDED.product_id) = 0
+                    RETURNING id, shopping_cart_id, product_id, quantity, updated_at, xmax = 0 AS created
+                )
+                SELECT line.id, line.shopping_cart_id, line.quantity, line.updated_at, line.created, product.id,
+                    product.name, product.price, product.minimum, product.amount_per_package,
+                    product.max_availability, product.updated_at
+                FROM line JOIN core_product product ON product.id = line.product_id
+            ''', params)
+            rows = cursor.fetchall()
+        shopping_products = []
+        total_price = line_count = 0
+        for (pk, shopping_cart_id, quantity, updated_at, created, product_id, name, price, minimum,
+             amount_per_package, max_availability, product_updated_at) in rows:
+            shopping_product = self.model(
+                id=pk, shopping_cart_id=shopping_cart_id, quantity=quantity, updated_at=updated_at,
+                product=Product(id=product_id, name=name, price=price, minimum=minimum,
+                                amount_per_package=amount_per_package, max_availability=max_availability,
+                                updated_at=product_updated_at)
+            )
+            shopping_product._loaded = (shopping_cart_id, quantity)
+            shopping_products.append(shopping_product)
+            total_price += quantities[product_id] * price
+            line_count += created
+        if shopping_products:
+            ShoppingCart.objects.filter(pk=shopping_products[0].shopping_cart_id).adjust(total_price, line_count)
+        return shopping_products
 
 
 class ShoppingProduct(models.Model):
+    # Indexed by the (shopping_cart, product) unique index and core_shoppingproduct_cart_idx.
     shopping_cart = models.ForeignKey(ShoppingCart, related_name='shopping_cart', blank=True, null=True,
-                                      on_delete=models.PROTECT)
+                                      on_delete=models.PROTECT, db_index=False)
     product = models.ForeignKey(Product, related_name='products', on_delete=models.PROTECT)
     quantity = models.BigIntegerField(verbose_name='quantity')
-    order = models.ForeignKey(Order, related_name='order_products', blank=True, null=True, on_delete=models.PROTECT)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    objects = ShoppingProductManager()
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded = (instance.__dict__.get('shopping_cart_id'), instance.__dict__.get('quantity'))
+        return instance
+
+    def adjust_cart(self, shopping_cart_id, quantity, line_count):
+        if shopping_cart_id is not None:
+            price = Product.objects.filter(pk=self.product_id).values('price')
+            ShoppingCart.objects.filter(pk=shopping_cart_id).adjust(Subquery(price) * quantity, line_count)
+
+    @transaction.atomic(savepoint=False)
+    def save(self, *args, **kwargs):
+        loaded_cart_id, loaded_quantity = getattr(self, '_loaded', (None, 0))
+        super().save(*args, **kwargs)
+        if loaded_cart_id == self.shopping_cart_id:
+            if self.quantity != loaded_quantity:
+                self.adjust_cart(self.shopping_cart_id, self.quantity - loaded_quantity, 0)
+        else:
+            self.adjust_cart(loaded_cart_id, -loaded_quantity, -1)
+            self.adjust_cart(self.shopping_cart_id, self.quantity, 1)
+        self._loaded = (self.shopping_cart_id, self.quantity)
+
+    @transaction.atomic(savepoint=False)
+    def delete(self, *args, **kwargs):
+        loaded_cart_id, loaded_quantity = getattr(self, '_loaded', (self.shopping_cart_id, self.quantity))
+        result = super().delete(*args, **kwargs)
+        self.adjust_cart(loaded_cart_id, -loaded_quantity, -1)
+        return result
 
     @property
     def partial_price(self):
@@ -53,3 +366,8 @@ class ShoppingProduct(models.Model):
 
     class Meta:
         unique_together = [['shopping_cart', 'product']]
+        indexes = [
+            # Cart lines of a cart, with what checkout reads from them, for index only scans.
+            models.Index(fields=['shopping_cart'], include=['product', 'quantity'],
+                         condition=models.Q(shopping_cart__isnull=False), name='core_shoppingproduct_cart_idx'),
+        ]
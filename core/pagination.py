@@ -0,0 +1,29 @@
+from rest_framework.pagination import CursorPagination
+from rest_framework.settings import api_settings
+
+
+class IdCursorPagination(CursorPagination):
+    ordering = 'id'
+    page_size_query_param = 'limit'
+    max_page_size = 500
+
+
+class OrderCursorPagination(IdCursorPagination):
+    ordering = '-created_at'
+
+
+class CursorPaginationMixin:
+    """Switches a viewset to keyset pagination when the request has ?cursor= or ?pagination=cursor.
+
+    Cursor pages are read with WHERE id > last_id ORDER BY id LIMIT n and no COUNT(*), so walking deep pages costs
+    the same as the first one. Other requests keep the default limit/offset pagination.
+    """
+    cursor_pagination_class = IdCursorPagination
+
+    @property
+    def pagination_class(self):
+        query_params = self.request.query_params
+        if self.cursor_pagination_class.cursor_query_param in query_params \
+                or query_params.get('pagination') == 'cursor':
+            return self.cursor_pagination_class
+        return api_settings.DEFAULT_PAGINATION_CLASS
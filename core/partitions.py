@@ -0,0 +1,175 @@
+import re
+from datetime import datetime, timezone
+
+from django.db import connection, transaction
+
+TABLE = 'core_orderproduct'
+DEFAULT_PARTITION = f'{TABLE}_default'
+PARTITION_NAME = re.compile(rf'^{TABLE}_(\d{{4}})_(\d{{2}})$')
+
+
+def month_start(value):
+    return datetime(value.year, value.month, 1, tzinfo=timezone.utc)
+
+
+def add_months(month, months):
+    index = month.year * 12 + month.month - 1 + months
+    return datetime(index // 12, index % 12 + 1, 1, tzinfo=timezone.utc)
+
+
+def partition_name(month):
+    return f'{TABLE}_{month:%Y_%m}'
+
+
+def partition_month(name):
+    """Returns the first day of the month stored by the partition, or None for the default partition."""
+    match = PARTITION_NAME.match(name)
+    return datetime(int(match[1]), int(match[2]), 1, tzinfo=timezone.utc) if match else None
+
+
+def is_partitioned():
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT relkind FROM pg_class WHERE oid = %s::regclass', [TABLE])
+        return cursor.fetchone()[0] == 'p'
+
+
+@transaction.atomic
+def create_partitions(start, end, table=TABLE):
+    """Creates the monthly partitions of the months from `start` to `end` that do not exist yet.
+
+    Lines of a month that went to the default partition while the month had no partition of its own are moved to
+    the new partition, as Postgres refuses to create a partition for rows the default partition holds. Returns the
+    names of the partitions created.
+    """
+    created = []
+    month = month_start(start)
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT EXISTS (SELECT 1 FROM pg_inherits WHERE inhrelid = to_regclass(%s) '
+                       'AND inhparent = %s::regclass)', [DEFAULT_PARTITION, table])
+        has_default = cursor.fetchone()[0]
+        while month <= end:
+            name = partition_name(month)
+            bounds = [month, add_months(month, 1)]
+            cursor.execute('SELECT to_regclass(%s)', [name])
+            if cursor.fetchone()[0] is None:
+                misplaced = False
+                if has_default:
+                    cursor.execute(f'SELECT EXISTS (SELECT 1 FROM {DEFAULT_PARTITION} '
+                                   f'WHERE created_at >= %s AND created_at < %s)', bounds)
+                    misplaced = cursor.fetchone()[0]
+                if misplaced:
+                    cursor.execute(f'ALTER TABLE {table} DETACH PARTITION {DEFAULT_PARTITION}')
+                cursor.execute(f'CREATE TABLE {name} PARTITION OF {table} FOR VALUES FROM (%s) TO (%s)', bounds)
+                if misplaced:
+                    cursor.execute(f'''
+                        WITH moved AS (
+                            DELETE FROM {DEFAULT_PARTITION} WHERE created_at >= %s AND created_at < %s RETURNING *
+                        )
+                        INSERT INTO {name} SELECT * FROM moved
+                    ''', bounds)
+                    cursor.execute(f'ALTER TABLE {table} ATTACH PARTITION {DEFAULT_PARTITION} DEFAULT')
+                created.append(name)
+            month = add_months(month, 1)
+    return created
+
+
+def partition_order_lines(months_ahead=3):
+    """Moves the order lines to a table range partitioned by month of `created_at`, the time of their order.
+
+    A partition is created for every month from the oldest order to `months_ahead` months from now, and a
+    default partition keeps lines outside of them. Queries filtering on `created_at` only read the partitions of
+    the months they ask for.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT pg_get_serial_sequence(%s, %s)', [TABLE, 'id'])
+        sequence = cursor.fetchone()[0]
+        cursor.execute(f'''
+            CREATE TABLE {TABLE}_partitioned (
+                id bigint NOT NULL DEFAULT nextval('{sequence}'),
+                order_id uuid NOT NULL CONSTRAINT {TABLE}_order_id_fk REFERENCES core_order (id)
+                    DEFERRABLE INITIALLY DEFERRED,
+                product_id bigint NULL CONSTRAINT {TABLE}_product_id_fk REFERENCES core_product (id)
+                    DEFERRABLE INITIALLY DEFERRED,
+                product_name varchar(512) NOT NULL,
+                price numeric(1000, 2) NOT NULL,
+                quantity bigint NOT NULL,
+                created_at timestamp with time zone NOT NULL,
+                CONSTRAINT {TABLE}_partitioned_pkey PRIMARY KEY (id, created_at)
+            ) PARTITION BY RANGE (created_at)
+        ''')
+        cursor.execute(f'CREATE INDEX {TABLE}_order_idx ON {TABLE}_partitioned (order_id)')
+        cursor.execute(f'CREATE INDEX {TABLE}_product_idx ON {TABLE}_partitioned (product_id)')
+        cursor.execute(f'CREATE TABLE {DEFAULT_PARTITION} PARTITION OF {TABLE}_partitioned DEFAULT')
+        cursor.execute('SELECT MIN(created_at) FROM core_order')
+        oldest = cursor.fetchone()[0] or datetime.now(timezone.utc)
+        create_partitions(oldest, add_months(datetime.now(timezone.utc), months_ahead), table=f'{TABLE}_partitioned')
+        cursor.execute(f'''
+            INSERT INTO {TABLE}_partitioned (id, order_id, product_id, product_name, price, quantity, created_at)
+            SELECT line.id, line.order_id, line.product_id, line.product_name, line.price, line.quantity,
+                orders.created_at
+            FROM {TABLE} line JOIN core_order orders ON orders.id = line.order_id
+        ''')
+        cursor.execute(f'ALTER SEQUENCE {sequence} OWNED BY {TABLE}_partitioned.id')
+        cursor.execute(f'DROP TABLE {TABLE}')
+        cursor.execute(f'ALTER TABLE {TABLE}_partitioned RENAME TO {TABLE}')
+        cursor.execute(f'ALTER TABLE {TABLE} RENAME CONSTRAINT {TABLE}_partitioned_pkey TO {TABLE}_pkey')
+        cursor.execute(f'ANALYZE {TABLE}')
+
+
+def unpartition_order_lines():
+    """Moves the order lines back to a plain table without `created_at`, undoing partition_order_lines().
+
+    Detached partitions are left as tables of their own, their lines are not moved back.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT pg_get_serial_sequence(%s, %s)', [TABLE, 'id'])
+        sequence = cursor.fetchone()[0]
+        cursor.execute(f'''
+            CREATE TABLE {TABLE}_plain (
+                id bigint NOT NULL DEFAULT nextval('{sequence}') CONSTRAINT {TABLE}_plain_pkey PRIMARY KEY,
+                order_id uuid NOT NULL CONSTRAINT {TABLE}_order_id_fk REFERENCES core_order (id)
+                    DEFERRABLE INITIALLY DEFERRED,
+                product_id bigint NULL CONSTRAINT {TABLE}_product_id_fk REFERENCES core_product (id)
+                    DEFERRABLE INITIALLY DEFERRED,
+                product_name varchar(512) NOT NULL,
+                price numeric(1000, 2) NOT NULL,
+                quantity bigint NOT NULL
+            )
+        ''')
+        # Indexed before the copy: the foreign key checks it defers would block creating indexes afterwards.
+        # Not named like the indexes of the partitioned table, which partition_order_lines() creates again.
+        cursor.execute(f'CREATE INDEX {TABLE}_order_id_idx ON {TABLE}_plain (order_id)')
+        cursor.execute(f'CREATE INDEX {TABLE}_product_id_idx ON {TABLE}_plain (product_id)')
+        cursor.execute(f'''
+            INSERT INTO {TABLE}_plain (id, order_id, product_id, product_name, price, quantity)
+            SELECT id, order_id, product_id, product_name, price, quantity FROM {TABLE}
+        ''')
+        cursor.execute(f'ALTER SEQUENCE {sequence} OWNED BY {TABLE}_plain.id')
+        cursor.execute(f'DROP TABLE {TABLE}')
+        cursor.execute(f'ALTER TABLE {TABLE}_plain RENAME TO {TABLE}')
+        cursor.execute(f'ALTER TABLE {TABLE} RENAME CONSTRAINT {TABLE}_plain_pkey TO {TABLE}_pkey')
+        cursor.execute(f'ANALYZE {TABLE}')
+
+
+def monthly_partitions():
+    """Returns the (name, month, attached) of the monthly partitions, detached ones included, oldest first."""
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT relname, relispartition FROM pg_class WHERE relkind = 'r' AND relname ~ %s "
+                       "ORDER BY relname", [PARTITION_NAME.pattern])
+        return [(name, partition_month(name), attached) for name, attached in cursor.fetchall()]
+
+
+def old_partitions(before):
+    """Returns the (name, attached) of the monthly partitions of the months before the month of `before`."""
+    return [(name, attached) for name, month, attached in monthly_partitions() if month < month_start(before)]
+
+
+def detach_partition(name):
+    """Detaches the partition, which stays as a table of its own, e.g. to be archived and dropped later."""
+    with connection.cursor() as cursor:
+        cursor.execute(f'ALTER TABLE {TABLE} DETACH PARTITION {connection.ops.quote_name(name)}')
+
+
+def drop_partition(name):
+    with connection.cursor() as cursor:
+        cursor.execute(f'DROP TABLE {connection.ops.quote_name(name)}')
@@ -1,54 +1,141 @@
-from django.db import IntegrityError, transaction
+from collections import defaultdict
+from datetime import timezone
+from decimal import Decimal
+
+from django.db import transaction
+from django.db.models import F, Q
+from django.db.models.expressions import RawSQL
 from django.db.transaction import TransactionManagementError
 from rest_framework import serializers
 
+from core.cache import product_cache
 from core.exceptions import ProductError, ProductQuantity, ProductPackageIntegrity, ProductDoesNotExist, \
-    ProductWrongField
-from core.models import Product, ShoppingCart, ShoppingProduct, Order
-from core.utils import valid_quantity
+    ProductWrongField, ProductQuantityExceeded
+from core.metrics import TimedSerializerMixin, timed_representation
+from core.models import Product, ShoppingCart, ShoppingProduct, Order, OrderProduct, CheckoutJob
+from core.utils import valid_quantity, lock_products, reserve_products
 
 
-class ProductSerializer(serializers.ModelSerializer):
+class ProductSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     class Meta:
         model = Product
         fields = '__all__'
 
 
-class ShoppingCartSerializer(serializers.ModelSerializer):
+class ProductImportSerializer(ProductSerializer):
+    """ProductSerializer rules for catalog imports, where a row with an id updates that product."""
+    id = serializers.IntegerField(required=False, min_value=1)
+
+
+BIGINT_MAX = 2 ** 63 - 1
+
+
+def to_integer(value, min_value, max_value=BIGINT_MAX):
+    """Returns `value` as an int when it is an integral number (or numeric string) within the bounds, else None.
+
+    Accepts what IntegerField accepts, so 2.0 passes but 1.9 and True don't.
+    """
+    if type(value) is int:
+        return value if min_value <= value <= max_value else None
+    if isinstance(value, bool) or not isinstance(value, (int, float, str)):
+        return None
+    try:
+        number = Decimal(str(value).strip())
+        if number != number.to_integral_value():
+            return None
+        number = int(number)
+    except (ArithmeticError, ValueError):
+        return None
+    return number if min_value <= number <= max_value else None
+
+
+def decimal_to_string(decimal_places):
+    quantum = Decimal(1).scaleb(-decimal_places)
+
+    def to_representation(value):
+        return '{:f}'.format(value.quantize(quantum))
+    return to_representation
+
+
+to_price = decimal_to_string(2)
+
+
+def datetime_to_string(value):
+    value = value.astimezone(timezone.utc).isoformat()
+    if value.endswith('+00:00'):
+        value = value[:-6] + 'Z'
+    return value
+
+
+class ValuesSerializer:
+    """Read only serializer building response dicts straight from queryset.values() rows.
+
+    `fields` maps every output field to the (lookup, to_representation) used to read and render it, so lists are
+    rendered without model instances nor per field serializer objects. The output must match the equivalent
+    ModelSerializer.
+    """
+    fields = {}
+
+    @classmethod
+    def lookups(cls):
+        return [lookup for lookup, to_representation in cls.fields.values()]
+
+    @classmethod
+    @timed_representation
+    def serialize(cls, rows):
+        fields = [(name, lookup, to_representation) for name, (lookup, to_representation) in cls.fields.items()]
+        return [{name: to_representation(row[lookup]) for name, lookup, to_representation in fields} for row in rows]
+
+
+class ProductValuesSerializer(ValuesSerializer):
+    fields = {
+        'id': ('id', int),
+        'name': ('name', str),
+        'price': ('price', decimal_to_string(2)),
+        'minimum': ('minimum', int),
+        'amount_per_package': ('amount_per_package', int),
+        'max_availability': ('max_availability', int),
+        'updated_at': ('updated_at', datetime_to_string),
+    }
+
+
+class ShoppingCartSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     class Meta:
         model = ShoppingCart
         fields = '__all__'
 
 
-class ShoppingProductSerializer(serializers.ModelSerializer):
+class ShoppingProductSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     product_name = serializers.CharField(source='product.name', read_only=True)
     price = serializers.CharField(source='product.price', read_only=True)
-    minimum = serializers.CharField(source='product.minimun', read_only=True)
+    minimum = serializers.CharField(source='product.minimum', read_only=True)
     amount_per_package = serializers.CharField(source='product.amount_per_package', read_only=True)
 
     class Meta:
         model = ShoppingProduct
         fields = ['id', 'product_name', 'price', 'minimum', 'amount_per_package', 'quantity']
 
-    @transaction.atomic(savepoint=False)
+    @transaction.atomic
     def create(self, request):
-        shopping_car, created = ShoppingCart.objects.get_or_create(user=self.context['request'].user)
-        try:
-            product = Product.objects.get(pk=self.initial_data.get('product'))
-        except (IntegrityError, Product.DoesNotExist):
+        user = self.context['request'].user
+        # Bounded to bigint before reaching the SQL, like the quote items.
+        product_id = to_integer(self.initial_data.get('product'), -BIGINT_MAX - 1)
+        if product_id is None:
             raise ProductDoesNotExist
-        quantity = int(self.initial_data.get('quantity'))
-        try:
-            product_inserted = ShoppingProduct.objects.get(shopping_cart=shopping_car,
-                                                           product=product)
-            product_inserted.quantity += quantity
-        except ShoppingProduct.DoesNotExist:
-            product_inserted = ShoppingProduct(shopping_cart=shopping_car,
-                                               product=product,
-                                               quantity=quantity)
-        if valid_quantity(product_inserted):
-            product_inserted.save()
-        return product_inserted
+        quantity = to_integer(self.initial_data.get('quantity'), 1)
+        if quantity is None:
+            raise ProductWrongField
+        shopping_products = ShoppingProduct.objects.add_to_cart(user.pk, {product_id: quantity})
+        if shopping_products:
+            return shopping_products[0]
+        # Nothing was written, find out which check rejected the line.
+        product = product_cache.get_product(product_id)
+        if product is None:
+            raise ProductDoesNotExist
+        inserted = ShoppingProduct.objects.filter(shopping_cart__user=user, product=product) \
+            .values_list('quantity', flat=True).first()
+        valid_quantity(ShoppingProduct(product=product, quantity=(inserted or 0) + quantity))
+        raise ProductQuantityExceeded
 
     def update(self, instance, validated_data):
         try:
@@ -65,22 +152,169 @@ class ShoppingProductSerializer(serializers.ModelSerializer):
             raise ProductWrongField
 
 
-class OrderSerializer(serializers.ModelSerializer):
+class ShoppingProductValuesSerializer(ValuesSerializer):
+    fields = {
+        'id': ('id', int),
+        'product_name': ('product__name', str),
+        'price': ('product__price', str),
+        'minimum': ('product__minimum', str),
+        'amount_per_package': ('product__amount_per_package', str),
+        'quantity': ('quantity', int),
+    }
+
+
+class ShoppingProductItemSerializer(serializers.Serializer):
+    product = serializers.IntegerField()
+    quantity = serializers.IntegerField(min_value=1)
+
+
+class ShoppingProductBulkSerializer(serializers.Serializer):
+    max_items = 1000
+    items = ShoppingProductItemSerializer(many=True, allow_empty=False)
+
+    def validate_items(self, items):
+        if len(items) > self.max_items:
+            raise serializers.ValidationError(f'Ensure this field has no more than {self.max_items} elements.')
+        return items
+
+    def validate(self, attrs):
+        user = self.context['request'].user
+        quantities = defaultdict(int)
+        for item in attrs['items']:
+            quantities[item['product']] += item['quantity']
+        products = product_cache.get_products(list(quantities))
+        inserted = dict(ShoppingProduct.objects.filter(shopping_cart__user=user, product_id__in=products)
+                        .values_list('product_id', 'quantity'))
+        errors = []
+        for item in attrs['items']:
+            product = products.get(item['product'])
+            if product is None:
+                errors.append({'product': [ProductDoesNotExist.default_detail]})
+                continue
+            product_inserted = ShoppingProduct(product=product,
+                                               quantity=inserted.get(product.pk, 0) + quantities[product.pk])
+            try:
+                valid_quantity(product_inserted)
+                errors.append({})
+            except (ProductQuantityExceeded, ProductPackageIntegrity) as exc:
+                errors.append({'quantity': [exc.detail]})
+        if any(errors):
+            raise serializers.ValidationError({'items': errors})
+        attrs['quantities'] = quantities
+        return attrs
+
+    @transaction.atomic(savepoint=False)
+    def create(self, validated_data):
+        shopping_products = ShoppingProduct.objects.add_to_cart(self.context['request'].user.pk,
+                                                                validated_data['quantities'])
+        if len(shopping_products) < len(validated_data['quantities']):
+            # A concurrent change made some line invalid after validation, roll back the whole batch.
+            raise ProductQuantityExceeded
+        return shopping_products
+
+
+class QuoteSerializer(serializers.Serializer):
+    """Prices lines and checks them like checkout would, from one query on the catalog and without the cart.
+
+    Lines of the same product are checked on their summed quantity, as they would be in a cart.
+    """
+    max_items = 10000
+    items = serializers.JSONField()
+
+    def validate_items(self, items):
+        # Plain checks rather than nested fields, which cost more than the quote itself on large requests.
+        if not isinstance(items, list) or not items:
+            raise serializers.ValidationError('Expected a non empty list of items.')
+        if len(items) > self.max_items:
+            raise serializers.ValidationError(f'Ensure this field has no more than {self.max_items} elements.')
+        lines = []
+        for index, item in enumerate(items):
+            if not isinstance(item, dict):
+                raise serializers.ValidationError(f'Item {index}: expected an object with product and quantity.')
+            product = to_integer(item.get('product'), -BIGINT_MAX - 1)
+            if product is None:
+                raise serializers.ValidationError(f'Item {index}: invalid product id {item.get("product")!r}.')
+            quantity = to_integer(item.get('quantity'), 1)
+            if quantity is None:
+                raise serializers.ValidationError(
+                    f'Item {index}: quantity must be an integer from 1 to {BIGINT_MAX}.')
+            lines.append((product, quantity))
+        return lines
+
+    def quote(self):
+        lines = self.validated_data['items']
+        quantities = defaultdict(int)
+        for product_id, quantity in lines:
+            quantities[product_id] += quantity
+        # An array parameter keeps the plan to index lookups, where thousands of IN values get a sequential scan.
+        product_ids = RawSQL('SELECT unnest(%s::bigint[])', [list(quantities)])
+        products = {pk: values for pk, *values in Product.objects.filter(pk__in=product_ids)
+                    .values_list('pk', 'price', 'minimum', 'amount_per_package', 'max_availability')}
+        total_price = Decimal(0)
+        quoted = []
+        for product_id, quantity in lines:
+            line = {'product': product_id, 'quantity': quantity, 'price': None, 'total_price': None, 'errors': []}
+            if product_id not in products:
+                line['errors'].append(ProductDoesNotExist.default_code)
+            else:
+                price, minimum, amount_per_package, max_availability = products[product_id]
+                line_total = price * quantity
+                total_price += line_total
+                # Prices have their two decimal places from the database, and so do their multiples.
+                line['price'], line['total_price'] = str(price), str(line_total)
+                in_cart = quantities[product_id]
+                if in_cart < minimum:
+                    line['errors'].append(ProductQuantity.default_code)
+                if in_cart % amount_per_package:
+                    line['errors'].append(ProductPackageIntegrity.default_code)
+                if in_cart > max_availability:
+                    line['errors'].append(ProductQuantityExceeded.default_code)
+            quoted.append(line)
+        return {
+            'valid': not any(line['errors'] for line in quoted),
+            'total_price': to_price(total_price),
+            'lines': quoted,
+        }
+
+
+class OrderProductSerializer(TimedSerializerMixin, serializers.ModelSerializer):
+    class Meta:
+        model = OrderProduct
+        fields = ['id', 'product', 'product_name', 'price', 'quantity']
+
+
+class OrderSerializer(TimedSerializerMixin, serializers.ModelSerializer):
+    lines = OrderProductSerializer(many=True, read_only=True)
+
     class Meta:
         model = Order
-        fields = '__all__'
+        fields = ['id', 'total_price', 'created_at', 'lines']
 
     @transaction.atomic(savepoint=True)
     def create(self, request):
         user = request.user
-        order = Order.objects.create(user=user)
         shopping_products = ShoppingProduct.objects.filter(shopping_cart__user=user)
-        for shopping_product in shopping_products:
-            if shopping_product.quantity >= shopping_product.product.minimum:
-                shopping_product.shopping_cart = None
-                shopping_product.order = order
-                shopping_product.save()
-            else:
+        # Empties the cart totals first, which locks the cart against concurrent additions.
+        ShoppingCart.objects.filter(user=user).update(total_price=0, line_count=0)
+        product_ids = lock_products(shopping_products)
+        invalid = shopping_products.filter(Q(quantity__lt=F('product__minimum')) |
+                                           Q(quantity__gt=F('product__max_availability'))) \
+            .select_related('product').order_by('id').first()
+        if invalid is not None:
+            if invalid.quantity < invalid.product.minimum:
                 raise ProductQuantity(
-                    detail=f'{shopping_product.product.name} - minimum: {shopping_product.product.minimum} - Requested: {shopping_product.quantity}')
+                    detail=f'{invalid.product.name} - minimum: {invalid.product.minimum} - Requested: {invalid.quantity}')
+            raise ProductQuantityExceeded(
+                detail=f'{invalid.product.name} - available: {invalid.product.max_availability} - Requested: {invalid.quantity}')
+        order = Order.objects.create_from_cart(user)
+        reserve_products(shopping_products, product_ids)
+        shopping_products.delete()
         return order
+
+
+class CheckoutJobSerializer(TimedSerializerMixin, serializers.ModelSerializer):
+    order = OrderSerializer(read_only=True)
+
+    class Meta:
+        model = CheckoutJob
+        fields = ['id', 'status', 'error', 'order', 'created_at', 'finished_at']
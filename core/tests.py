@@ -1,21 +1,49 @@
+import asyncio
+import io
 import itertools
 import json
+import threading
 from collections import OrderedDict
+from datetime import timedelta
 from decimal import Decimal
 from urllib.parse import urlencode
 
+import psycopg2
 import pytest
+from asgiref.sync import async_to_sync
 from django.contrib.auth import get_user_model
+from django.db import close_old_connections, connection, transaction
+from django.db.models import Count, F
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.http import HttpResponse
+from django.test import AsyncClient, RequestFactory
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from django.utils.http import http_date
 
 # Create your tests here.
 from django.urls import reverse
 from rest_framework import status
+from rest_framework.renderers import JSONRenderer
 from rest_framework_simplejwt.serializers import TokenObtainPairSerializer
-
+from rest_framework_simplejwt.tokens import AccessToken
+
+from core import benchmark_suite, carts, partitions
+from core.cache import LRUCache, product_cache
+from core.catalog import import_products
+from core.datagen import Generator
+from core.jobs import process_jobs, run_workers
+from core.middleware import RequestMetricsMiddleware
 from core.exceptions import ProductQuantityExceeded, ProductPackageIntegrity, ProductDoesNotExist
-from core.models import ShoppingProduct, ShoppingCart, Product
+from core.models import ShoppingProduct, ShoppingCart, Product, Order, OrderProduct, CheckoutJob, \
+    IdempotencyKey, ArchivedShoppingCart
+from core.serializers import OrderSerializer, ProductSerializer, ShoppingProductSerializer, ProductValuesSerializer, \
+    ShoppingProductValuesSerializer
 from core.utils import valid_quantity
 from core.views import ShoppingCartViewSet, ProductViewSet
+from marketplace.db.base import ConnectionPool
 from rest_framework.test import APIClient
 from rest_framework.test import APIRequestFactory
 from rest_framework.test import force_authenticate
@@ -25,6 +53,13 @@ pytestmark = pytest.mark.django_db
 User = get_user_model()
 
 
+@pytest.fixture(autouse=True)
+def empty_product_cache():
+    # Test transactions are rolled back without the signals invalidating the catalog cache.
+    product_cache.local.clear()
+    product_cache.shared.clear()
+
+
 @pytest.fixture
 def user_data():
     return {
@@ -360,3 +395,1090 @@ def test_get_product_list_filtered(created_user, product_inserted, product_inser
     force_authenticate(request, user=user)
     response = view(request)
     assert response.data.get('results')[0]['name'] == "any other name"
+
+
+@pytest.mark.parametrize('cart_size', [1, 30])
+def test_get_shopping_cart_query_count(created_user, shopping_cart, django_assert_num_queries, cart_size):
+    products = Product.objects.bulk_create(
+        Product(name=f'product {i}', price=Decimal('10.00'), minimum=1, amount_per_package=1, max_availability=100)
+        for i in range(cart_size)
+    )
+    ShoppingProduct.objects.bulk_create(
+        ShoppingProduct(shopping_cart=shopping_cart, product=product, quantity=2) for product in products
+    )
+    ShoppingCart.objects.filter(pk=shopping_cart.pk).refresh_totals()
+    url = reverse('shopping-cart-list')
+    factory = APIRequestFactory()
+    view = ShoppingCartViewSet.as_view({'get': 'list'})
+    request = factory.get(url)
+    force_authenticate(request, user=created_user)
+    # Conditional GET validators, count, page and stored total price.
+    with django_assert_num_queries(4):
+        response = view(request).render()
+    content = json.loads(response.content)
+    assert Decimal(str(content['total_price'])) == Decimal('20.00') * cart_size
+    assert content['count'] == cart_size
+
+
+def test_get_shopping_cart_only_user_products(created_user, product_inserted, product_inserted2):
+    url = reverse('shopping-cart-list')
+    factory = APIRequestFactory()
+    view = ShoppingCartViewSet.as_view({'get': 'list'})
+    request = factory.get(url)
+    force_authenticate(request, user=created_user)
+    response = view(request)
+    assert [item['id'] for item in response.data['results']] == [product_inserted.pk]
+    assert response.data['total_price'] == product_inserted.partial_price
+
+
+@pytest.mark.parametrize('cart_size', [10, 100])
+def test_checkout_query_count(created_user, shopping_cart, django_assert_num_queries, cart_size):
+    products = Product.objects.bulk_create(
+        Product(name=f'product {i}', price=Decimal('10.00'), minimum=1, amount_per_package=1, max_availability=100)
+        for i in range(cart_size)
+    )
+    ShoppingProduct.objects.bulk_create(
+        ShoppingProduct(shopping_cart=shopping_cart, product=product, quantity=2) for product in products
+    )
+    ShoppingCart.objects.filter(pk=shopping_cart.pk).refresh_totals()
+    request = APIRequestFactory().post(reverse('checkout'))
+    request.user = created_user
+    with django_assert_num_queries(8):
+        order = OrderSerializer().create(request)
+    assert order.lines.count() == cart_size
+    assert order.total_price == Decimal('20.00') * cart_size
+    assert not ShoppingProduct.objects.filter(shopping_cart=shopping_cart).exists()
+
+
+def test_checkout_reserves_availability(created_user, product_inserted, product_inserted3):
+    request = APIRequestFactory().post(reverse('checkout'))
+    request.user = created_user
+    OrderSerializer().create(request)
+    assert Product.objects.get(pk=product_inserted.product_id).max_availability == 5000 - 24
+    assert Product.objects.get(pk=product_inserted3.product_id).max_availability == 5000 - 24
+
+
+def test_checkout_invalidates_reserved_products_only(created_user, product_inserted, django_assert_num_queries):
+    other = Product.objects.create(name='other', price=Decimal('1.00'), minimum=1, amount_per_package=1,
+                                   max_availability=10)
+    assert product_cache.get_product(product_inserted.product_id).max_availability == 5000
+    product_cache.get_product(other.pk)
+    request = APIRequestFactory().post(reverse('checkout'))
+    request.user = created_user
+    OrderSerializer().create(request)
+    assert product_cache.get_product(product_inserted.product_id).max_availability == 5000 - 24
+    with django_assert_num_queries(0):
+        assert product_cache.get_products([other.pk]) == {other.pk: other}
+
+
+def test_checkout_fail_availability_exceeded(created_user, product_inserted):
+    Product.objects.filter(pk=product_inserted.product_id).update(max_availability=12)
+    url = reverse('checkout')
+    factory = APIRequestFactory()
+    view = ShoppingCartViewSet.as_view({'post': 'checkout'})
+    request = factory.post(url)
+    force_authenticate(request, user=created_user)
+    response = view(request).render()
+    assert json.loads(response.content) == {'detail': 'any name - available: 12 - Requested: 24'}
+    assert ShoppingProduct.objects.filter(shopping_cart__user=created_user).count() == 1
+
+
+@pytest.mark.django_db(transaction=True)
+def test_concurrent_checkout_does_not_oversell():
+    hot_products = [
+        Product.objects.create(name=f'hot product {i}', price=Decimal('1.00'), minimum=1, amount_per_package=1,
+                               max_availability=10)
+        for i in range(2)
+    ]
+    users = []
+    for i in range(8):
+        user = User.objects.create(username=f'buyer {i}')
+        shopping_cart = ShoppingCart.objects.create(user=user)
+        # Alternate the insertion order so that lock ordering, not insertion order, prevents deadlocks.
+        for product in (hot_products if i % 2 else reversed(hot_products)):
+            ShoppingProduct.objects.create(shopping_cart=shopping_cart, product=product, quantity=4)
+        users.append(user)
+
+    barrier = threading.Barrier(len(users))
+    results = []
+
+    def checkout(user):
+        request = APIRequestFactory().post(reverse('checkout'))
+        request.user = user
+        barrier.wait()
+        try:
+            OrderSerializer().create(request)
+            results.append(True)
+        except ProductQuantityExceeded:
+            results.append(False)
+        finally:
+            connection.close()
+
+    threads = [threading.Thread(target=checkout, args=(user,)) for user in users]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert results.count(True) == 2
+    for product in hot_products:
+        product.refresh_from_db()
+        assert product.max_availability == 2
+        assert OrderProduct.objects.filter(product=product).count() == 2
+
+
+@pytest.mark.django_db(transaction=True)
+def test_concurrent_line_update_and_checkout():
+    user = User.objects.create(username='busy buyer')
+    products = [Product.objects.create(name=f'product {i}', price=Decimal('1.00'), minimum=1, amount_per_package=1,
+                                       max_availability=10 ** 6) for i in range(2)]
+    errors = []
+
+    def run(view, request, **kwargs):
+        force_authenticate(request, user=user)
+        barrier.wait()
+        try:
+            view(request, **kwargs)
+        except Exception as exc:
+            errors.append(exc)
+        finally:
+            connection.close()
+
+    for _ in range(20):
+        lines = ShoppingProduct.objects.add_to_cart(user.pk, {product.pk: 2 for product in products})
+        barrier = threading.Barrier(2)
+        update = APIRequestFactory().patch(reverse('shopping-cart-detail', kwargs={'pk': lines[0].pk}),
+                                           {'quantity': 3})
+        checkout = APIRequestFactory().post(reverse('checkout'))
+        threads = [
+            threading.Thread(target=run, args=(ShoppingCartViewSet.as_view({'patch': 'partial_update'}), update),
+                             kwargs={'pk': lines[0].pk}),
+            threading.Thread(target=run, args=(ShoppingCartViewSet.as_view({'post': 'checkout'}), checkout)),
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    assert errors == []
+    assert not ShoppingCart.objects.drifted().exists()
+
+
+def test_checkout_respond_async(created_user, created_user2, product_inserted, product_inserted3):
+    client = APIClient()
+    client.force_authenticate(user=created_user)
+    response = client.post(reverse('checkout'), HTTP_PREFER='respond-async')
+    assert response.status_code == status.HTTP_202_ACCEPTED
+    assert response.json()['status'] == 'pending' and response.json()['order'] is None
+    location = response['Location']
+    assert location.endswith(reverse('checkout-jobs-detail', kwargs={'pk': response.json()['id']}))
+    assert ShoppingProduct.objects.filter(shopping_cart__user=created_user).count() == 2
+    assert process_jobs() == 1
+    job = client.get(location).json()
+    assert job['status'] == 'done' and job['error'] == '' and job['finished_at'] is not None
+    assert Decimal(job['order']['total_price']) == product_inserted.partial_price + product_inserted3.partial_price
+    assert len(job['order']['lines']) == 2
+    assert not ShoppingProduct.objects.filter(shopping_cart__user=created_user).exists()
+    client.force_authenticate(user=created_user2)
+    assert client.get(location).status_code == status.HTTP_404_NOT_FOUND
+
+
+def test_checkout_job_failed(created_user, product_inserted):
+    Product.objects.filter(pk=product_inserted.product_id).update(max_availability=12)
+    job = CheckoutJob.objects.create(user=created_user)
+    assert process_jobs() == 1
+    job.refresh_from_db()
+    assert (job.status, job.error, job.order, job.attempts) == ('failed', 'any name - available: 12 - Requested: 24',
+                                                                None, 1)
+    assert ShoppingProduct.objects.filter(shopping_cart__user=created_user).count() == 1
+
+
+@pytest.mark.django_db(transaction=True)
+def test_checkout_workers_do_not_oversell():
+    hot_product = Product.objects.create(name='hot product', price=Decimal('1.00'), minimum=1, amount_per_package=1,
+                                         max_availability=30)
+    for i in range(20):
+        user = User.objects.create(username=f'queued buyer {i}')
+        shopping_cart = ShoppingCart.objects.create(user=user)
+        ShoppingProduct.objects.create(shopping_cart=shopping_cart, product=hot_product, quantity=2)
+        CheckoutJob.objects.create(user=user)
+    assert run_workers(workers=4, batch_size=3, until_empty=True) == 20
+    statuses = dict(CheckoutJob.objects.values_list('status').annotate(count=Count('*')))
+    assert statuses == {'done': 15, 'failed': 5}
+    assert Order.objects.count() == 15
+    hot_product.refresh_from_db()
+    assert hot_product.max_availability == 0
+
+
+def test_bulk_insert_products(created_user, product_inserted, product2, django_assert_num_queries):
+    url = reverse('shopping-cart-bulk')
+    factory = APIRequestFactory()
+    view = ShoppingCartViewSet.as_view({'post': 'bulk'})
+    request = factory.post(url, data={'items': [
+        {'product': product_inserted.product_id, 'quantity': 12},
+        {'product': product2.pk, 'quantity': 2},
+        {'product': product2.pk, 'quantity': 4},
+    ]}, format='json')
+    force_authenticate(request, user=created_user)
+    # Products, existing lines, add to cart and cart totals.
+    with django_assert_num_queries(4):
+        response = view(request).render()
+    assert response.status_code == status.HTTP_201_CREATED
+    assert {item['product_name']: item['quantity'] for item in json.loads(response.content)} == {
+        'any name': 36, 'any other name': 6}
+    assert ShoppingProduct.objects.filter(shopping_cart__user=created_user).count() == 2
+
+
+def test_bulk_insert_products_item_errors(created_user, product, product2):
+    url = reverse('shopping-cart-bulk')
+    factory = APIRequestFactory()
+    view = ShoppingCartViewSet.as_view({'post': 'bulk'})
+    request = factory.post(url, data={'items': [
+        {'product': product.pk, 'quantity': 13},
+        {'product': product2.pk, 'quantity': 2},
+        {'product': 999, 'quantity': 2},
+        {'product': product2.pk, 'quantity': product2.max_availability},
+    ]}, format='json')
+    force_authenticate(request, user=created_user)
+    response = view(request).render()
+    assert response.status_code == status.HTTP_400_BAD_REQUEST
+    assert json.loads(response.content) == {'items': [
+        {'quantity': ['Product package could not be split']},
+        {'quantity': ['Product quantity exceed']},
+        {'product': ['Product requested does not exist']},
+        {'quantity': ['Product quantity exceed']},
+    ]}
+    assert not ShoppingProduct.objects.filter(shopping_cart__user=created_user).exists()
+
+
+def test_insert_product_query_count(created_user, product_inserted, django_assert_num_queries):
+    url = reverse('shopping-cart-list')
+    factory = APIRequestFactory()
+    view = ShoppingCartViewSet.as_view({'post': 'create'})
+    request = factory.post(url, data={
+        "product": product_inserted.product_id,
+        "quantity": 12
+    })
+    force_authenticate(request, user=created_user)
+    # Add to cart and cart totals, in a savepoint of the test transaction (a transaction of its own when served).
+    with django_assert_num_queries(4):
+        response = view(request)
+    assert response.status_code == status.HTTP_201_CREATED
+    assert response.data['quantity'] == 36
+    assert response.data['product_name'] == 'any name'
+
+
+@pytest.mark.django_db(transaction=True)
+def test_concurrent_insert_product():
+    user = User.objects.create(username='concurrent buyer')
+    product = Product.objects.create(name='hot product', price=Decimal('1.00'), minimum=1, amount_per_package=12,
+                                     max_availability=60)
+    url = reverse('shopping-cart-list')
+    view = ShoppingCartViewSet.as_view({'post': 'create'})
+    barrier = threading.Barrier(8)
+    status_codes = []
+
+    def insert_product():
+        request = APIRequestFactory().post(url, data={"product": product.pk, "quantity": 12})
+        force_authenticate(request, user=user)
+        barrier.wait()
+        try:
+            status_codes.append(view(request).status_code)
+        finally:
+            connection.close()
+
+    threads = [threading.Thread(target=insert_product) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert sorted(status_codes) == [status.HTTP_201_CREATED] * 5 + [status.HTTP_400_BAD_REQUEST] * 3
+    assert ShoppingProduct.objects.get(shopping_cart__user=user, product=product).quantity == 60
+
+
+def test_idempotent_cart_add(created_user, product_inserted, django_assert_num_queries):
+    client = APIClient()
+    client.force_authenticate(user=created_user)
+    url = reverse('shopping-cart-list')
+    data = {'product': product_inserted.product_id, 'quantity': 12}
+    first = client.post(url, data, HTTP_IDEMPOTENCY_KEY='add-1')
+    assert first.status_code == status.HTTP_201_CREATED and first.json()['quantity'] == 36
+    # The key claim returns the stored response; the savepoint comes from the test transaction.
+    with django_assert_num_queries(3):
+        retry = client.post(url, data, HTTP_IDEMPOTENCY_KEY='add-1')
+    assert (retry.status_code, retry.json(), retry['Idempotent-Replayed']) == (first.status_code, first.json(), 'true')
+    assert ShoppingProduct.objects.get(pk=product_inserted.pk).quantity == 36
+    assert ShoppingCart.objects.get(user=created_user).total_price == Decimal('36000.00')
+    response = client.post(url, {'product': product_inserted.product_id, 'quantity': 24}, HTTP_IDEMPOTENCY_KEY='add-1')
+    assert response.status_code == status.HTTP_422_UNPROCESSABLE_ENTITY
+    assert client.post(url, data, HTTP_IDEMPOTENCY_KEY='add-2').json()['quantity'] == 48
+    assert client.post(url, data).json()['quantity'] == 60
+
+
+def test_idempotent_checkout(created_user, created_user2, product_inserted, product_inserted2):
+    client = APIClient()
+    client.force_authenticate(user=created_user)
+    Product.objects.filter(pk=product_inserted.product_id).update(max_availability=12)
+    # Failed requests store nothing, so the retry runs once the cart is fixed.
+    assert client.post(reverse('checkout'), HTTP_IDEMPOTENCY_KEY='checkout-1').status_code == 400
+    Product.objects.filter(pk=product_inserted.product_id).update(max_availability=5000)
+    first = client.post(reverse('checkout'), HTTP_IDEMPOTENCY_KEY='checkout-1')
+    assert first.status_code == status.HTTP_200_OK
+    retry = client.post(reverse('checkout'), HTTP_IDEMPOTENCY_KEY='checkout-1')
+    assert retry.json() == first.json() and retry['Idempotent-Replayed'] == 'true'
+    assert Order.objects.filter(user=created_user).count() == 1
+    # Keys belong to their user.
+    client.force_authenticate(user=created_user2)
+    response = client.post(reverse('checkout'), HTTP_IDEMPOTENCY_KEY='checkout-1', HTTP_PREFER='respond-async')
+    assert response.status_code == status.HTTP_202_ACCEPTED
+    retry = client.post(reverse('checkout'), HTTP_IDEMPOTENCY_KEY='checkout-1', HTTP_PREFER='respond-async')
+    assert (retry.json(), retry['Location']) == (response.json(), response['Location'])
+    assert CheckoutJob.objects.count() == 1
+
+
+def test_sweep_idempotency_keys(created_user, product_inserted, settings):
+    client = APIClient()
+    client.force_authenticate(user=created_user)
+    url = reverse('shopping-cart-list')
+    data = {'product': product_inserted.product_id, 'quantity': 12}
+    settings.IDEMPOTENCY_KEY_TTL = -1
+    for key in ('a', 'b', 'c'):
+        client.post(url, data, HTTP_IDEMPOTENCY_KEY=key)
+    # An expired key is used again for the new request.
+    response = client.post(url, data, HTTP_IDEMPOTENCY_KEY='a')
+    assert response.json()['quantity'] == 72 and not response.has_header('Idempotent-Replayed')
+    settings.IDEMPOTENCY_KEY_TTL = 3600
+    client.post(url, data, HTTP_IDEMPOTENCY_KEY='d')
+    stdout = io.StringIO()
+    call_command('sweep_idempotency_keys', batch_size=2, stdout=stdout)
+    assert stdout.getvalue().strip() == 'deleted=3'
+    assert list(IdempotencyKey.objects.values_list('key', flat=True)) == ['d']
+
+
+@pytest.mark.django_db(transaction=True)
+def test_concurrent_idempotent_requests():
+    user = User.objects.create(username='retrying buyer')
+    product = Product.objects.create(name='retried product', price=Decimal('1.00'), minimum=1, amount_per_package=1,
+                                     max_availability=60)
+    barrier = threading.Barrier(6)
+    responses = []
+
+    def insert_product():
+        client = APIClient()
+        client.force_authenticate(user=user)
+        barrier.wait()
+        try:
+            response = client.post(reverse('shopping-cart-list'), {'product': product.pk, 'quantity': 5},
+                                   HTTP_IDEMPOTENCY_KEY='retry')
+            responses.append((response.status_code, response.json()))
+        finally:
+            connection.close()
+
+    threads = [threading.Thread(target=insert_product) for _ in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(responses) == 6 and all(response == responses[0] for response in responses)
+    assert responses[0][0] == status.HTTP_201_CREATED
+    assert ShoppingProduct.objects.get(shopping_cart__user=user, product=product).quantity == 5
+
+
+def test_quote(created_user, product_inserted, product2, django_assert_num_queries):
+    client = APIClient()
+    client.force_authenticate(user=created_user)
+    items = [
+        {'product': product_inserted.product_id, 'quantity': 12},
+        {'product': product2.pk, 'quantity': 1},
+        {'product': product_inserted.product_id, 'quantity': 1},
+        {'product': 0, 'quantity': 2},
+        {'product': product2.pk, 'quantity': 5001},
+    ]
+    with django_assert_num_queries(1):
+        response = client.post(reverse('quote-list'), {'items': items}, format='json')
+    assert response.status_code == status.HTTP_200_OK
+    quote = response.json()
+    assert quote['valid'] is False
+    assert quote['total_price'] == '513200.00'
+    assert [(line['price'], line['total_price'], line['errors']) for line in quote['lines']] == [
+        ('1000.00', '12000.00', ['product_package_split_error']),
+        ('100.00', '100.00', ['product_quantity_exceed']),
+        ('1000.00', '1000.00', ['product_package_split_error']),
+        (None, None, ['product_does_not_exist']),
+        ('100.00', '500100.00', ['product_quantity_exceed']),
+    ]
+    response = client.post(reverse('quote-list'), {'items': [{'product': product2.pk, 'quantity': 4}]}, format='json')
+    assert response.json() == {'valid': True, 'total_price': '400.00', 'lines': [
+        {'product': product2.pk, 'quantity': 4, 'price': '100.00', 'total_price': '400.00', 'errors': []}]}
+    response = client.post(reverse('quote-list'), {'items': [{'product': product2.pk, 'quantity': 1}]}, format='json')
+    assert response.json()['lines'][0]['errors'] == ['product_less_than_minimum', 'product_package_split_error']
+    # The cart is left alone.
+    assert ShoppingProduct.objects.get(pk=product_inserted.pk).quantity == 24
+    assert client.post(reverse('quote-list'), {'items': [{'product': str(product2.pk), 'quantity': 4.0}]},
+                       format='json').json()['valid'] is True
+    for items in ([], [{'product': product2.pk}], [{'product': product2.pk, 'quantity': 0}], {'product': 1},
+                  [{'product': product2.pk + 0.9, 'quantity': 4}], [{'product': 2 ** 63, 'quantity': 4}],
+                  [{'product': True, 'quantity': 4}], [{'product': product2.pk, 'quantity': 4.5}], [4]):
+        response = client.post(reverse('quote-list'), {'items': items}, format='json')
+        assert response.status_code == status.HTTP_400_BAD_REQUEST
+
+
+def test_get_product_list_without_name_does_not_filter(created_user, product, product2):
+    url = reverse('products-list')
+    factory = APIRequestFactory()
+    view = ProductViewSet.as_view({'get': 'list'})
+    request = factory.get(url)
+    force_authenticate(request, user=created_user)
+    with CaptureQueriesContext(connection) as queries:
+        response = view(request)
+    assert response.data['count'] == 2
+    assert not any('LIKE' in query['sql'] for query in queries)
+
+
+def test_get_product_list_cursor_pagination(created_user):
+    Product.objects.bulk_create(
+        Product(name=f'product {i}', price=Decimal('10.00'), minimum=1, amount_per_package=1, max_availability=100)
+        for i in range(5)
+    )
+    view = ProductViewSet.as_view({'get': 'list'})
+    url = f"{reverse('products-list')}?{urlencode({'pagination': 'cursor', 'limit': 2})}"
+    names = []
+    with CaptureQueriesContext(connection) as queries:
+        while url:
+            request = APIRequestFactory().get(url)
+            force_authenticate(request, user=created_user)
+            response = view(request)
+            names.extend(item['name'] for item in response.data['results'])
+            url = response.data['next']
+    assert names == [f'product {i}' for i in range(5)]
+    assert not any('OFFSET' in query['sql'] for query in queries)
+    # Only the conditional GET validators count rows, once for every page.
+    assert len([query for query in queries if 'COUNT' in query['sql']]) == 1
+
+
+def test_get_product_reads_through_cache(created_user, product, django_assert_num_queries):
+    url = reverse('products-detail', kwargs={'pk': product.pk})
+    view = ProductViewSet.as_view({'get': 'retrieve'})
+    request = APIRequestFactory().get(url)
+    force_authenticate(request, user=created_user)
+    view(request, pk=product.pk)
+    with django_assert_num_queries(0):
+        response = view(request, pk=product.pk)
+    assert response.data['name'] == 'any name'
+
+    product.name = 'renamed'
+    product.save()
+    response = view(request, pk=product.pk)
+    assert response.data['name'] == 'renamed'
+
+
+def test_get_product_list_cache_invalidated_on_delete(created_user, product, product2):
+    url = reverse('products-list')
+    view = ProductViewSet.as_view({'get': 'list'})
+    request = APIRequestFactory().get(url, {'name': 'other'})
+    force_authenticate(request, user=created_user)
+    assert view(request).data['count'] == 1
+    product2.delete()
+    assert view(request).data['count'] == 0
+
+
+def test_lru_cache_eviction():
+    cache = LRUCache(maxsize=2, ttl=30)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert cache.get('a') == 1
+    cache.set('c', 3)
+    assert cache.get('b') is None
+    assert cache.stats() == {'hits': 1, 'misses': 1, 'evictions': 1, 'size': 2}
+
+
+def test_get_product_list_not_modified(created_user, product, django_assert_num_queries):
+    url = reverse('products-list')
+    view = ProductViewSet.as_view({'get': 'list'})
+    request = APIRequestFactory().get(url)
+    force_authenticate(request, user=created_user)
+    response = view(request)
+    assert response.status_code == status.HTTP_200_OK
+    assert 'Last-Modified' not in response
+
+    request = APIRequestFactory().get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+    force_authenticate(request, user=created_user)
+    with django_assert_num_queries(0):
+        assert view(request).status_code == status.HTTP_304_NOT_MODIFIED
+
+    product.price = Decimal('1.00')
+    product.save()
+    assert view(request).status_code == status.HTTP_200_OK
+
+
+def test_get_product_list_etag_matches_body(created_user, created_user2, product_inserted,
+                                            django_assert_num_queries):
+    view = ProductViewSet.as_view({'get': 'list'})
+
+    def get(user):
+        request = APIRequestFactory().get(reverse('products-list'))
+        force_authenticate(request, user=user)
+        response = view(request)
+        return response['ETag'], response.data['results'][0]['max_availability']
+
+    etag, max_availability = get(created_user2)
+    request = APIRequestFactory().post(reverse('checkout'))
+    request.user = created_user
+    OrderSerializer().create(request)
+    # A listing body is only reused with the ETag of the state it was built under.
+    other_etag, other_max_availability = get(created_user)
+    assert (other_etag == etag) == (other_max_availability == max_availability)
+    # The catalog validators are shared by every user.
+    product_cache.invalidate()
+    etag = get(created_user2)[0]
+    with django_assert_num_queries(0):
+        assert get(created_user)[0] == etag
+
+
+def test_get_shopping_cart_not_modified(created_user, product_inserted, product_inserted3):
+    url = reverse('shopping-cart-list')
+    view = ShoppingCartViewSet.as_view({'get': 'list'})
+    request = APIRequestFactory().get(url)
+    force_authenticate(request, user=created_user)
+    etag = view(request)['ETag']
+
+    request = APIRequestFactory().get(url, HTTP_IF_NONE_MATCH=etag)
+    force_authenticate(request, user=created_user)
+    assert view(request).status_code == status.HTTP_304_NOT_MODIFIED
+
+    product_inserted3.delete()
+    response = view(request)
+    assert response.status_code == status.HTTP_200_OK
+    assert response['ETag'] != etag
+
+
+def test_get_shopping_cart_modified_after_delete(created_user, product_inserted, product_inserted3):
+    url = reverse('shopping-cart-list')
+    view = ShoppingCartViewSet.as_view({'get': 'list'})
+    request = APIRequestFactory().get(url, HTTP_IF_MODIFIED_SINCE=http_date())
+    force_authenticate(request, user=created_user)
+    assert view(request).status_code == status.HTTP_200_OK
+
+    product_inserted3.delete()
+    response = view(request)
+    assert response.status_code == status.HTTP_200_OK
+    assert len(response.data['results']) == 1
+
+
+def test_values_serializers_match_model_serializers(product_inserted, product_inserted3):
+    renderer = JSONRenderer()
+    products = Product.objects.order_by('id')
+    assert renderer.render(ProductValuesSerializer.serialize(products.values(*ProductValuesSerializer.lookups()))) \
+        == renderer.render(ProductSerializer(products, many=True).data)
+    shopping_products = ShoppingProduct.objects.select_related('product').order_by('id')
+    assert renderer.render(ShoppingProductValuesSerializer.serialize(
+        shopping_products.values(*ShoppingProductValuesSerializer.lookups()))) \
+        == renderer.render(ShoppingProductSerializer(shopping_products, many=True).data)
+
+
+def test_cached_jwt_authentication(created_user, product, django_assert_num_queries):
+    client = APIClient()
+    client.credentials(HTTP_AUTHORIZATION=f'Bearer {AccessToken.for_user(created_user)}')
+    url = reverse('products-detail', kwargs={'pk': product.pk})
+    assert client.get(url).status_code == status.HTTP_200_OK
+    with django_assert_num_queries(0):
+        assert client.get(url).status_code == status.HTTP_200_OK
+
+    created_user.is_active = False
+    created_user.save()
+    assert client.get(url).status_code == status.HTTP_401_UNAUTHORIZED
+
+
+@pytest.mark.django_db(transaction=True)
+def test_async_views(created_user, product):
+    client = AsyncClient()
+    # AsyncClient sends extra keyword arguments as raw ASGI headers.
+    headers = {'authorization': f'Bearer {AccessToken.for_user(created_user)}'}
+    response = async_to_sync(client.get)(reverse('async-products-list'), **headers)
+    assert response.status_code == status.HTTP_200_OK
+    assert response.json()['results'][0]['name'] == 'any name'
+
+    response = async_to_sync(client.post)(reverse('async-shopping-cart-list'),
+                                          {'product': product.pk, 'quantity': 12},
+                                          content_type='application/json', **headers)
+    assert response.status_code == status.HTTP_201_CREATED
+    response = async_to_sync(client.get)(reverse('async-shopping-cart-list'), **headers)
+    assert response.json()['results'][0]['quantity'] == 12
+
+
+class FakeConnection:
+    closed = False
+
+    def get_transaction_status(self):
+        return psycopg2.extensions.TRANSACTION_STATUS_IDLE
+
+    def close(self):
+        self.closed = True
+
+
+def test_connection_pool_is_bounded():
+    pool = ConnectionPool(FakeConnection, size=1, timeout=0.01)
+    first, reused = pool.acquire()
+    assert reused is False
+    with pytest.raises(psycopg2.OperationalError):
+        pool.acquire()
+    pool.release(first)
+    second, reused = pool.acquire()
+    assert second is first and reused is True
+    assert pool.stats() == {'size': 1, 'connections': 1, 'idle': 0, 'checkouts': 2, 'waits': 1, 'timeouts': 1}
+
+
+@pytest.mark.django_db(transaction=True)
+def test_health_check_replaces_dropped_connection():
+    connection.ensure_connection()
+    backend_pid = connection.connection.get_backend_pid()
+    with psycopg2.connect(**connection.get_connection_params()) as other, other.cursor() as cursor:
+        cursor.execute('SELECT pg_terminate_backend(%s)', [backend_pid])
+    # Start a new request with a persistent connection.
+    connection.close_at = None
+    close_old_connections()
+    assert Product.objects.count() == 0
+    assert connection.connection.get_backend_pid() != backend_pid
+
+
+def test_request_metrics(created_user, product, settings):
+    settings.REQUEST_METRICS_SAMPLE_RATE = 1
+    client = APIClient()
+    client.force_authenticate(user=created_user)
+    response = client.get(reverse('products-detail', kwargs={'pk': product.pk}))
+    assert response.status_code == status.HTTP_200_OK
+    assert response['Server-Timing'].startswith('db;dur=')
+    assert 'serialize;dur=' in response['Server-Timing'] and 'render;dur=' in response['Server-Timing']
+    assert 'total;dur=' in response['Server-Timing']
+    assert client.get(reverse('metrics')).status_code == status.HTTP_403_FORBIDDEN
+    created_user.is_staff = True
+    client.force_authenticate(user=created_user)
+    response = client.get(reverse('metrics'))
+    assert response.status_code == status.HTTP_200_OK
+    body = response.content.decode()
+    assert 'marketplace_request_duration_seconds_count{route="products-detail"}' in body
+    assert 'marketplace_db_queries_bucket{route="products-detail",le="+Inf"}' in body
+    assert 'marketplace_product_cache_hits' in body
+    assert 'marketplace_serialize_duration_seconds_count{route="products-detail"}' in body
+
+
+def test_request_metrics_async(settings):
+    settings.REQUEST_METRICS_SAMPLE_RATE = 1
+
+    async def get_response(request):
+        await asyncio.sleep(0)
+        return HttpResponse()
+    middleware = RequestMetricsMiddleware(get_response)
+    assert asyncio.iscoroutinefunction(middleware)
+    response = asyncio.run(middleware(RequestFactory().get('/')))
+    # No view reported its queries, so the database time is left out rather than reported as zero.
+    assert response['Server-Timing'].startswith('serialize;dur=')
+
+
+@pytest.mark.django_db(transaction=True)
+def test_request_metrics_asgi(created_user, product_inserted, settings):
+    settings.REQUEST_METRICS_SAMPLE_RATE = 1
+    client = AsyncClient()
+    headers = {'authorization': f'Bearer {AccessToken.for_user(created_user)}'}
+    for url in (reverse('shopping-cart-list'), reverse('async-shopping-cart-list')):
+        response = async_to_sync(client.get)(url, **headers)
+        assert response.status_code == status.HTTP_200_OK
+        queries = int(response['Server-Timing'].split('desc="')[1].split(' ')[0])
+        assert queries > 0, url
+
+
+def test_request_metrics_sampling(created_user, product, settings):
+    settings.REQUEST_METRICS_SAMPLE_RATE = 0
+    client = APIClient()
+    client.force_authenticate(user=created_user)
+    response = client.get(reverse('products-detail', kwargs={'pk': product.pk}))
+    assert response.status_code == status.HTTP_200_OK
+    assert 'Server-Timing' not in response
+
+
+@pytest.mark.django_db(transaction=True)
+def test_benchmark_suite(settings):
+    settings.ALLOWED_HOSTS = ['localhost']
+    report = benchmark_suite.run_suite(products=20, users=4, cart_size=2, requests=8, concurrency=2)
+    for scenario, result in report['scenarios'].items():
+        assert result['requests'] == 8
+        assert set(result['statuses']) <= {'200', '201'}, scenario
+    assert not Product.objects.exists() and not User.objects.exists()
+    slower = json.loads(json.dumps(report))
+    slower['scenarios']['checkout']['p95_ms'] = report['scenarios']['checkout']['p95_ms'] * 2
+    assert benchmark_suite.compare(report, slower)[1] == ['checkout']
+
+
+def test_generate_data():
+    counts = Generator(products=50, users=10, carts=6, orders=4, seed=1).generate()
+    assert Product.objects.count() == 50 and User.objects.count() == 10
+    assert ShoppingCart.objects.count() == 6 and Order.objects.count() == 4
+    assert ShoppingProduct.objects.count() == counts['cart_lines'] > 0
+    assert not ShoppingCart.objects.drifted().exists()
+    for line in ShoppingProduct.objects.select_related('product'):
+        assert line.quantity % line.product.amount_per_package == 0
+    for order in Order.objects.prefetch_related('lines__product'):
+        assert order.total_price == sum(line.partial_price for line in order.lines.all())
+        for line in order.lines.all():
+            assert (line.product_name, line.price) == (line.product.name, line.product.price)
+    # The sequences continue after the generated rows.
+    assert Product.objects.create(name='new', price=1, minimum=1, amount_per_package=1, max_availability=1).pk == \
+        Product.objects.order_by('pk').values_list('pk', flat=True)[49] + 1
+    # The same seed generates the same rows, but for ids and timestamps.
+    rows = [[row[1:-1] for row in Generator(50, 0, 0, 0, seed=1).product_rows()] for _ in range(2)]
+    assert rows[0] == rows[1]
+
+
+def test_import_products(created_user, product, product_inserted):
+    client = APIClient()
+    client.force_authenticate(user=created_user)
+    upload = SimpleUploadedFile('products.csv', (
+        'id,name,price,minimum,amount_per_package,max_availability\n'
+        f'{product.pk},renamed,12.50,1,1,10\n'
+        ',"new, product",3.00,2,2,100\n'
+        f'{product.pk + 100},with id,1.00,1,1,5\n'
+    ).encode())
+    response = client.post(reverse('products-import-file'), {'file': upload}, format='multipart')
+    assert response.status_code == status.HTTP_200_OK
+    assert response.json() == {'created': 2, 'updated': 1}
+    assert Product.objects.get(pk=product.pk).price == Decimal('12.50')
+    assert ShoppingCart.objects.get(pk=product_inserted.shopping_cart_id).total_price == Decimal('300.00')
+    assert Product.objects.filter(name='new, product').exists()
+    # The sequence continues after the imported ids.
+    assert Product.objects.create(name='next', price=1, minimum=1, amount_per_package=1,
+                                  max_availability=1).pk > product.pk + 100
+
+
+@pytest.mark.parametrize('batch_size', [1, 5000])
+def test_import_products_ids_above_sequence(product, batch_size):
+    explicit_id = product.pk + 2
+    stream = io.BytesIO((
+        'id,name,price,minimum,amount_per_package,max_availability\n'
+        f'{explicit_id},explicit,1.00,1,1,1\n'
+        ',new-a,1.00,1,1,1\n'
+        ',new-b,1.00,1,1,1\n'
+        ',new-c,1.00,1,1,1\n'
+    ).encode())
+    assert import_products(stream, batch_size=batch_size) == (4, 0)
+    assert Product.objects.get(pk=explicit_id).name == 'explicit'
+    assert Product.objects.filter(name__startswith='new-', pk__gt=explicit_id).count() == 3
+
+
+def test_import_products_invalid_rows(created_user, product):
+    client = APIClient()
+    client.force_authenticate(user=created_user)
+    upload = SimpleUploadedFile('products.jsonl', (
+        '{"name": "valid", "price": "1.00", "minimum": 1, "amount_per_package": 1, "max_availability": 1}\n'
+        '{"name": "invalid", "price": "free", "minimum": 1, "amount_per_package": 1, "max_availability": 1}\n'
+    ).encode())
+    response = client.post(reverse('products-import-file'), {'file': upload}, format='multipart')
+    assert response.status_code == status.HTTP_400_BAD_REQUEST
+    assert list(response.json()) == ['row 2']
+    assert Product.objects.count() == 1
+
+
+def test_export_products(created_user, product, product2):
+    client = APIClient()
+    client.force_authenticate(user=created_user)
+    response = client.get(reverse('products-export-file'), {'export_format': 'jsonl'})
+    assert response.status_code == status.HTTP_200_OK
+    rows = [json.loads(line) for line in b''.join(response.streaming_content).decode().splitlines()]
+    assert rows == ProductSerializer(Product.objects.order_by('id'), many=True).data
+    response = client.get(reverse('products-export-file'))
+    assert response['Content-Type'] == 'text/csv'
+    lines = b''.join(response.streaming_content).decode().splitlines()
+    assert lines[0] == 'id,name,price,minimum,amount_per_package,max_availability,updated_at'
+    assert len(lines) == 3
+
+
+def test_cart_totals_maintained(created_user, product, product2):
+    client = APIClient()
+    client.force_authenticate(user=created_user)
+
+    def totals():
+        shopping_cart = ShoppingCart.objects.get(user=created_user)
+        assert not ShoppingCart.objects.drifted().exists()
+        return shopping_cart.total_price, shopping_cart.line_count
+
+    client.post(reverse('shopping-cart-list'), {'product': product.pk, 'quantity': 12})
+    client.post(reverse('shopping-cart-list'), {'product': product.pk, 'quantity': 12})
+    assert totals() == (Decimal('24000.00'), 1)
+    client.post(reverse('shopping-cart-bulk'), {'items': [{'product': product2.pk, 'quantity': 4}]}, format='json')
+    assert totals() == (Decimal('24400.00'), 2)
+    line = ShoppingProduct.objects.get(product=product2)
+    client.patch(reverse('shopping-cart-detail', kwargs={'pk': line.pk}), {'quantity': 2})
+    assert totals() == (Decimal('24200.00'), 2)
+    product = Product.objects.get(pk=product.pk)
+    product.price = Decimal('500.00')
+    product.save()
+    assert totals() == (Decimal('12200.00'), 2)
+    client.delete(reverse('shopping-cart-detail', kwargs={'pk': line.pk}))
+    assert totals() == (Decimal('12000.00'), 1)
+    response = client.get(reverse('shopping-cart-list'))
+    assert Decimal(str(response.json()['total_price'])) == Decimal('12000.00')
+    client.post(reverse('checkout'))
+    assert totals() == (0, 0)
+
+
+def test_cart_totals_repriced_from_stored_price(created_user, product_inserted):
+    stale = Product.objects.get(pk=product_inserted.product_id)
+    Product.objects.filter(pk=stale.pk).update(price=Decimal('30.00'))
+    ShoppingCart.objects.refresh_totals()
+    stale.price = Decimal('40.00')
+    stale.save()
+    assert ShoppingCart.objects.get(user=created_user).total_price == Decimal('40.00') * product_inserted.quantity
+    assert not ShoppingCart.objects.drifted().exists()
+
+
+def test_check_cart_totals(product_inserted):
+    ShoppingCart.objects.update(total_price=1, line_count=5)
+    out = io.StringIO()
+    call_command('check_cart_totals', '--repair', stdout=out)
+    assert out.getvalue().strip() == 'drifted=1 repaired=1'
+    assert not ShoppingCart.objects.drifted().exists()
+
+
+def test_rejected_cart_add_creates_no_cart(created_user, product):
+    client = APIClient()
+    client.force_authenticate(user=created_user)
+    response = client.post(reverse('shopping-cart-list'), {'product': product.pk,
+                                                           'quantity': product.max_availability * 2})
+    assert response.status_code == status.HTTP_400_BAD_REQUEST
+    assert not ShoppingCart.objects.filter(user=created_user).exists()
+    for data in ({'product': 2 ** 63, 'quantity': 12}, {'product': product.pk + 0.5, 'quantity': 12},
+                 {'product': product.pk, 'quantity': -12}):
+        response = client.post(reverse('shopping-cart-list'), data, format='json')
+        assert response.status_code == status.HTTP_400_BAD_REQUEST, data
+    assert not ShoppingCart.objects.filter(user=created_user).exists()
+
+
+def test_cart_last_activity(created_user, product_inserted):
+    long_ago = timezone.now() - timedelta(days=100)
+    ShoppingCart.objects.update(last_activity=long_ago)
+    ShoppingCart.objects.refresh_totals()
+    assert ShoppingCart.objects.get(user=created_user).last_activity == long_ago
+    client = APIClient()
+    client.force_authenticate(user=created_user)
+    client.patch(reverse('shopping-cart-detail', kwargs={'pk': product_inserted.pk}), {'quantity': 12})
+    assert ShoppingCart.objects.get(user=created_user).last_activity > long_ago
+    ShoppingCart.objects.update(last_activity=long_ago)
+    client.post(reverse('shopping-cart-list'), {'product': product_inserted.product_id, 'quantity': 12})
+    assert ShoppingCart.objects.get(user=created_user).last_activity > long_ago
+
+
+def test_sweep_carts(created_user, created_user2, product_inserted, product_inserted2, product_inserted3):
+    idle_users = [User.objects.create(username=f'idle {i}') for i in range(3)]
+    for user in idle_users:
+        ShoppingCart.objects.create(user=user)
+    idle = ShoppingCart.objects.exclude(user=created_user2)
+    idle.update(last_activity=timezone.now() - timedelta(days=31))
+    stdout = io.StringIO()
+    call_command('sweep_carts', idle_days=30, batch_size=2, pause=0, archive=True, stdout=stdout)
+    assert stdout.getvalue().startswith('carts=4 lines=2 rows_per_second=')
+    assert list(ShoppingCart.objects.values_list('user', flat=True)) == [created_user2.pk]
+    archived = ArchivedShoppingCart.objects.get(user=created_user)
+    assert (archived.total_price, archived.line_count) == (Decimal('26400.00'), 2)
+    assert archived.lines == [{'product': product_inserted.product_id, 'quantity': 24},
+                              {'product': product_inserted3.product_id, 'quantity': 24}]
+    assert ArchivedShoppingCart.objects.filter(user=idle_users[0], lines=[]).exists()
+    # The next addition starts a new cart.
+    client = APIClient()
+    client.force_authenticate(user=created_user)
+    client.post(reverse('shopping-cart-list'), {'product': product_inserted.product_id, 'quantity': 12})
+    assert ShoppingCart.objects.get(user=created_user).total_price == Decimal('12000.00')
+    ShoppingCart.objects.update(last_activity=timezone.now() - timedelta(days=31))
+    call_command('sweep_carts', idle_days=30, stdout=io.StringIO())
+    assert not ShoppingCart.objects.exists()
+    assert ArchivedShoppingCart.objects.count() == 4
+
+
+@pytest.mark.django_db(transaction=True)
+def test_sweep_skips_carts_with_locked_lines():
+    user = User.objects.create(username='idle buyer')
+    product = Product.objects.create(name='idle product', price=Decimal('1.00'), minimum=1, amount_per_package=1,
+                                     max_availability=10)
+    line = ShoppingProduct.objects.add_to_cart(user.pk, {product.pk: 2})[0]
+    ShoppingCart.objects.update(last_activity=timezone.now() - timedelta(days=31))
+    locked, release = threading.Event(), threading.Event()
+
+    def lock_line():
+        try:
+            with transaction.atomic():
+                ShoppingProduct.objects.select_for_update().get(pk=line.pk)
+                locked.set()
+                release.wait(10)
+        finally:
+            connection.close()
+
+    thread = threading.Thread(target=lock_line)
+    thread.start()
+    locked.wait(10)
+    try:
+        assert carts.sweep_batch(0, timezone.now(), 10) == (line.shopping_cart_id, 1, 0, 0)
+    finally:
+        release.set()
+        thread.join()
+    assert carts.sweep_batch(0, timezone.now(), 10) == (line.shopping_cart_id, 1, 1, 1)
+
+
+def test_order_history(created_user, created_user2, product_inserted, product_inserted2, product_inserted3,
+                       django_assert_num_queries):
+    client = APIClient()
+    client.force_authenticate(user=created_user)
+    assert client.post(reverse('checkout')).status_code == status.HTTP_200_OK
+    assert not ShoppingProduct.objects.filter(shopping_cart__user=created_user).exists()
+    # Order lines keep the price they were sold at.
+    Product.objects.filter(pk=product_inserted.product_id).update(price=Decimal('1.00'))
+    with django_assert_num_queries(2):
+        response = client.get(reverse('orders-list'))
+    assert response.status_code == status.HTTP_200_OK
+    orders = response.json()['results']
+    assert len(orders) == 1 and response.json()['next'] is None
+    assert Decimal(orders[0]['total_price']) == product_inserted.partial_price + product_inserted3.partial_price
+    assert [(line['product_name'], line['price'], line['quantity']) for line in orders[0]['lines']] == [
+        ('any name', '1000.00', 24), (product_inserted3.product.name, f'{product_inserted3.product.price}', 24)]
+    response = client.get(reverse('orders-detail', kwargs={'pk': orders[0]['id']}))
+    assert response.json() == orders[0]
+    client.force_authenticate(user=created_user2)
+    assert client.get(reverse('orders-list')).json()['results'] == []
+
+
+def explain_seq_scans(sql):
+    """Returns the tables a statement reads with a sequential scan, although sequential scans are disabled."""
+    with connection.cursor() as cursor:
+        cursor.execute(f'EXPLAIN (FORMAT JSON) {sql}')
+        plans = [cursor.fetchone()[0][0]['Plan']]
+    tables = []
+    while plans:
+        plan = plans.pop()
+        if plan['Node Type'] == 'Seq Scan':
+            tables.append(plan['Relation Name'])
+        plans.extend(plan.get('Plans', []))
+    return tables
+
+
+def test_viewset_queries_use_indexes(created_user, product, product2):
+    Generator(products=500, users=50, carts=50, orders=100, seed=2).generate()
+    product_cache.clear()
+    client = APIClient()
+    client.force_authenticate(user=created_user)
+    with CaptureQueriesContext(connection) as queries:
+        client.get(reverse('products-list'))
+        client.get(reverse('products-list'), {'pagination': 'cursor'})
+        client.get(reverse('products-detail', kwargs={'pk': product.pk}))
+        client.post(reverse('shopping-cart-list'), {'product': product.pk, 'quantity': 12})
+        client.post(reverse('shopping-cart-bulk'), {'items': [{'product': product2.pk, 'quantity': 2}]}, format='json')
+        line = ShoppingProduct.objects.get(shopping_cart__user=created_user, product=product2)
+        client.get(reverse('shopping-cart-list'))
+        client.get(reverse('shopping-cart-detail', kwargs={'pk': line.pk}))
+        client.patch(reverse('shopping-cart-detail', kwargs={'pk': line.pk}), {'quantity': 4})
+        client.delete(reverse('shopping-cart-detail', kwargs={'pk': line.pk}))
+        client.post(reverse('checkout'))
+        order_id = client.get(reverse('orders-list')).json()['results'][0]['id']
+        client.get(reverse('orders-detail', kwargs={'pk': order_id}))
+    with connection.cursor() as cursor:
+        cursor.execute('SET LOCAL enable_seqscan = off')
+    statements = [query['sql'] for query in queries.captured_queries
+                  if query['sql'].lstrip().startswith(('SELECT', 'UPDATE', 'DELETE', 'INSERT', 'WITH'))]
+    assert len(statements) > 20
+    seq_scans = {sql: tables for sql in statements for tables in [explain_seq_scans(sql)] if tables}
+    assert seq_scans == {}
+
+
+def explain_partitions(sql):
+    """Returns the order line partitions a statement reads."""
+    with connection.cursor() as cursor:
+        cursor.execute(f'EXPLAIN (FORMAT JSON) {sql}')
+        plans = [cursor.fetchone()[0][0]['Plan']]
+    tables = set()
+    while plans:
+        plan = plans.pop()
+        if plan.get('Relation Name', '').startswith(partitions.TABLE):
+            tables.add(plan['Relation Name'])
+        plans.extend(plan.get('Plans', []))
+    return tables
+
+
+def test_order_lines_partitioned(created_user, product_inserted, product_inserted3):
+    partitions.partition_order_lines()
+    Generator(products=200, users=20, carts=0, orders=2000, order_days=3 * 365, seed=3).generate()
+    now = timezone.now()
+    months = [month for name, month, attached in partitions.monthly_partitions()]
+    assert len(months) >= 37 and months[-1] == partitions.add_months(partitions.month_start(now), 3)
+    assert not OrderProduct.objects.filter(created_at__lt=F('order__created_at')).exists()
+    with connection.cursor() as cursor:
+        cursor.execute(f'SELECT COUNT(*) FROM {partitions.DEFAULT_PARTITION}')
+        assert cursor.fetchone()[0] == 0
+
+    client = APIClient()
+    client.force_authenticate(user=created_user)
+    assert client.post(reverse('checkout')).status_code == status.HTTP_200_OK
+    order = Order.objects.get(user=created_user)
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT DISTINCT tableoid::regclass::text FROM core_orderproduct WHERE order_id = %s',
+                       [order.pk])
+        assert cursor.fetchall() == [(partitions.partition_name(now),)]
+
+    # History pages and order details only read the partitions of the months of their orders.
+    user = User.objects.filter(username__startswith='generated-').annotate(orders=Count('user_order')) \
+        .order_by('-orders').first()
+    client.force_authenticate(user=user)
+    with CaptureQueriesContext(connection) as queries:
+        page = client.get(reverse('orders-list'), {'limit': 5}).json()['results']
+        detail = client.get(reverse('orders-detail', kwargs={'pk': page[-1]['id']})).json()
+    assert detail == page[-1] and len(page) == 5
+    page_months = {partitions.partition_name(partitions.month_start(parse_datetime(order['created_at'])))
+                   for order in page}
+    lines_sql = [query['sql'] for query in queries.captured_queries if 'FROM "core_orderproduct"' in query['sql']]
+    assert len(lines_sql) == 2
+    assert explain_partitions(lines_sql[0]) <= page_months | {partitions.partition_name(now)}
+    assert explain_partitions(lines_sql[1]) == {partitions.partition_name(
+        partitions.month_start(parse_datetime(detail['created_at'])))}
+
+    stdout = io.StringIO()
+    call_command('order_partitions', 'create', months_ahead=5, stdout=stdout)
+    assert stdout.getvalue().count('created') == 2
+    before = partitions.add_months(partitions.month_start(now), -24)
+    old_lines = OrderProduct.objects.filter(created_at__lt=before).count()
+    assert old_lines > 0
+    call_command('order_partitions', 'detach', before=f'{before:%Y-%m}', stdout=stdout)
+    assert not OrderProduct.objects.filter(created_at__lt=before).exists()
+    detached = [name for name, month, attached in partitions.monthly_partitions() if not attached]
+    assert len(detached) >= 12 and all(partitions.partition_month(name) < before for name in detached)
+    with connection.cursor() as cursor:
+        # Checks the foreign keys deferred by this test transaction, which block dropping the tables.
+        cursor.execute('SET CONSTRAINTS ALL IMMEDIATE')
+    call_command('order_partitions', 'drop', before=f'{before:%Y-%m}', stdout=stdout)
+    assert all(attached for name, month, attached in partitions.monthly_partitions())
+    assert OrderProduct.objects.filter(order=order).count() == 2
+
+
+def test_unpartition_order_lines(created_user, product):
+    partitions.partition_order_lines(months_ahead=0)
+    order = Order.objects.create(user=created_user, total_price=Decimal('1000.00'))
+    OrderProduct.objects.create(order=order, product=product, product_name=product.name, price=product.price,
+                                quantity=1, created_at=order.created_at)
+    with connection.cursor() as cursor:
+        # Checks the foreign keys deferred by this test transaction, which block dropping the tables.
+        cursor.execute('SET CONSTRAINTS ALL IMMEDIATE')
+        cursor.execute('SET CONSTRAINTS ALL DEFERRED')
+    partitions.unpartition_order_lines()
+    assert not partitions.is_partitioned()
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT order_id, quantity FROM core_orderproduct')
+        assert cursor.fetchall() == [(order.pk, 1)]
+
+
+def test_create_partition_moves_default_partition_lines(created_user, product):
+    partitions.partition_order_lines(months_ahead=0)
+    month = partitions.add_months(partitions.month_start(timezone.now()), 2)
+    order = Order.objects.create(user=created_user, total_price=Decimal('1000.00'))
+    line = OrderProduct.objects.create(order=order, product=product, product_name=product.name, price=product.price,
+                                       quantity=1, created_at=month + timedelta(days=3))
+    assert partitions.create_partitions(month, month) == [partitions.partition_name(month)]
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT tableoid::regclass::text FROM core_orderproduct WHERE id = %s', [line.pk])
+        assert cursor.fetchone()[0] == partitions.partition_name(month)
+        cursor.execute(f'SELECT COUNT(*) FROM {partitions.DEFAULT_PARTITION}')
+        assert cursor.fetchone()[0] == 0
@@ -2,14 +2,21 @@ from django.urls import include
 from django.urls.conf import path
 from rest_framework.routers import DefaultRouter
 
-from core import views
+from core import async_views, views
 
 router = DefaultRouter()
 router.register(r'products', views.ProductViewSet, basename='products')
 router.register(r'shopping_cart', views.ShoppingCartViewSet, basename='shopping-cart')
+router.register(r'quote', views.QuoteViewSet, basename='quote')
+router.register(r'orders', views.OrderViewSet, basename='orders')
+router.register(r'checkout/jobs', views.CheckoutJobViewSet, basename='checkout-jobs')
 checkout = views.ShoppingCartViewSet.as_view({'post': 'checkout'})
 
 urlpatterns = [
     path('', include(router.urls)),
     path('checkout/', checkout, name='checkout'),
+    path('metrics/', views.metrics, name='metrics'),
+    path('async/products/', async_views.product_list, name='async-products-list'),
+    path('async/products/<int:pk>/', async_views.product_detail, name='async-products-detail'),
+    path('async/shopping_cart/', async_views.shopping_cart_list, name='async-shopping-cart-list'),
 ]
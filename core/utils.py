@@ -1,9 +1,36 @@
+from django.db.models import F, OuterRef, Subquery
+from django.db.models.functions import Now
+
+from core.cache import product_cache
 from core.exceptions import ProductPackageIntegrity, ProductQuantityExceeded
+from core.models import Product, ShoppingProduct
 
 
 def valid_quantity(product_inserted):
+    if not ShoppingProduct.product.is_cached(product_inserted):
+        product_inserted.product = product_cache.get_product(product_inserted.product_id)
     if product_inserted.quantity > product_inserted.product.max_availability:
         raise ProductQuantityExceeded
     if not product_inserted.package_integrity:
         raise ProductPackageIntegrity
     return True
+
+
+def lock_products(shopping_products):
+    """Locks the products of the given cart lines in id order, so concurrent checkouts queue instead of deadlocking."""
+    return list(Product.objects.select_for_update()
+                .filter(pk__in=shopping_products.values('product_id'))
+                .order_by('pk')
+                .values_list('pk', flat=True))
+
+
+def reserve_products(shopping_products, product_ids):
+    """Takes the quantity of every given cart line out of its product availability with one UPDATE.
+
+    `product_ids` are the products of the lines, as returned by lock_products(). Only their cache entries are
+    invalidated.
+    """
+    quantity = shopping_products.filter(product=OuterRef('pk')).values('quantity')[:1]
+    product_cache.invalidate_products(product_ids)
+    return Product.objects.filter(pk__in=product_ids) \
+        .update(max_availability=F('max_availability') - Subquery(quantity), updated_at=Now())
@@ -1,47 +1,223 @@
+from django.db import transaction
+from django.http import Http404, HttpResponse, StreamingHttpResponse
 from django.shortcuts import render
 
 # Create your views here.
 from django_filters.rest_framework import DjangoFilterBackend
-from rest_framework import viewsets, filters
-from rest_framework.permissions import IsAuthenticated
-from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework import mixins, viewsets, filters, status
+from rest_framework.decorators import action, api_view, authentication_classes, permission_classes
+from rest_framework.exceptions import ValidationError
+from rest_framework.parsers import MultiPartParser
+from rest_framework.permissions import IsAuthenticated, IsAdminUser
+from rest_framework.response import Response
+from rest_framework.reverse import reverse
 
-from core.models import Product, ShoppingProduct
-from core.serializers import ProductSerializer, ShoppingProductSerializer, OrderSerializer
+from core.authentication import CachedJWTAuthentication
+from core.catalog import export_products, get_format, import_products
+from core.cache import product_cache
+from core.conditional import conditional_get
+from core.idempotency import idempotent
+from core.metrics import request_metrics
+from core.models import CheckoutJob, Order, Product, ShoppingCart, ShoppingProduct
+from core.pagination import CursorPaginationMixin, OrderCursorPagination
+from core.serializers import ProductSerializer, ShoppingProductSerializer, OrderSerializer, \
+    ShoppingProductBulkSerializer, ProductValuesSerializer, ShoppingProductValuesSerializer, CheckoutJobSerializer, \
+    QuoteSerializer
 
 
-class ProductViewSet(viewsets.ModelViewSet):
-    authentication_classes = (JWTAuthentication,)
+@api_view(['GET'])
+@authentication_classes([CachedJWTAuthentication])
+@permission_classes([IsAdminUser])
+def metrics(request):
+    """Prometheus scrape endpoint for the metrics of this process, for admin users like cache_stats."""
+    return HttpResponse(request_metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+class ValuesListMixin:
+    """Renders list responses with `values_serializer_class` from queryset.values() rows, when it is set."""
+    values_serializer_class = None
+
+    def list(self, request, *args, **kwargs):
+        if self.values_serializer_class is None:
+            return super().list(request, *args, **kwargs)
+        queryset = self.filter_queryset(self.get_queryset()).values(*self.values_serializer_class.lookups())
+        page = self.paginate_queryset(queryset)
+        if page is not None:
+            return self.get_paginated_response(self.values_serializer_class.serialize(page))
+        return Response(self.values_serializer_class.serialize(queryset))
+
+
+class ProductViewSet(ValuesListMixin, CursorPaginationMixin, viewsets.ModelViewSet):
+    authentication_classes = (CachedJWTAuthentication,)
     permission_classes = [IsAuthenticated, ]
-    queryset = Product.objects.all()
+    queryset = Product.objects.order_by('id')
     serializer_class = ProductSerializer
+    values_serializer_class = ProductValuesSerializer
     filter_backends = (filters.SearchFilter,)
 
     def filter_queryset(self, queryset):
-        return queryset.filter(name__icontains=self.request.query_params.get('name', ''))
+        name = self.request.query_params.get('name')
+        if name:
+            queryset = queryset.filter(name__icontains=name)
+        return queryset
+
+    @conditional_get(cache=product_cache, per_user=False)
+    def list(self, request, *args, **kwargs):
+        return super().list(request, *args, **kwargs)
+
+    @conditional_get(detail=True, cache=product_cache, per_user=False)
+    def retrieve(self, request, *args, **kwargs):
+        try:
+            product = product_cache.get_product(int(kwargs[self.lookup_field]))
+        except ValueError:
+            raise Http404
+        if product is None:
+            raise Http404
+        return Response(self.get_serializer(product).data)
 
+    @action(detail=False, permission_classes=[IsAdminUser])
+    def cache_stats(self, request, *args, **kwargs):
+        return Response(product_cache.stats())
 
-class ShoppingCartViewSet(viewsets.ModelViewSet):
-    authentication_classes = (JWTAuthentication,)
+    @action(detail=False, methods=['post'], url_path='import', parser_classes=[MultiPartParser])
+    def import_file(self, request, *args, **kwargs):
+        upload = request.FILES.get('file')
+        if upload is None:
+            raise ValidationError({'file': ['No file was submitted.']})
+        file_format = get_format(request.query_params.get('import_format') or upload.name)
+        created, updated = import_products(upload, file_format)
+        return Response({'created': created, 'updated': updated})
+
+    @action(detail=False, url_path='export')
+    def export_file(self, request, *args, **kwargs):
+        file_format = get_format(request.query_params.get('export_format'))
+        response = StreamingHttpResponse(export_products(file_format),
+                                         content_type='text/csv' if file_format == 'csv' else 'application/x-ndjson')
+        response['Content-Disposition'] = f'attachment; filename="products.{file_format}"'
+        return response
+
+
+class ShoppingCartViewSet(ValuesListMixin, CursorPaginationMixin, viewsets.ModelViewSet):
+    authentication_classes = (CachedJWTAuthentication,)
     permission_classes = [IsAuthenticated, ]
-    queryset = ShoppingProduct.objects.filter(shopping_cart__isnull=False)
+    queryset = ShoppingProduct.objects.filter(shopping_cart__isnull=False).select_related('product')
     serializer_class = ShoppingProductSerializer
+    values_serializer_class = ShoppingProductValuesSerializer
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        if self.action in ('list', 'checkout'):
+            queryset = queryset.filter(shopping_cart__user=self.request.user).order_by('id')
+        elif self.action in ('update', 'partial_update', 'destroy'):
+            # Keeps the line quantity from changing until the cart totals are adjusted.
+            queryset = queryset.select_for_update(of=('self',))
+        return queryset
+
+    def lock_cart(self):
+        """Locks the cart of the requested line before the line, in the order checkout and cart additions use."""
+        try:
+            list(ShoppingCart.objects.select_for_update(of=('self',))
+                 .filter(shopping_cart__pk=self.kwargs[self.lookup_field]).values_list('pk', flat=True))
+        except (TypeError, ValueError):
+            pass
 
     def get_products(self, request):
-        shopping_cart_products = ShoppingProduct.objects.filter(shopping_cart__user=request.user)
-        total_price = sum(map(lambda products: products.partial_price, shopping_cart_products))
+        shopping_cart_products = self.get_queryset()
+        total_price = ShoppingCart.objects.filter(user=request.user).values_list('total_price', flat=True) \
+            .first() or 0
         return total_price, shopping_cart_products
 
+    @conditional_get(fields=('updated_at', 'product__updated_at'))
     def list(self, request, *args, **kwargs):
         response = super().list(request, args, kwargs)
         total_price, shopping_cart_products = self.get_products(request)
         response.data = dict(total_price=total_price, **response.data)
         return response
 
+    @conditional_get(fields=('updated_at', 'product__updated_at'), detail=True)
+    def retrieve(self, request, *args, **kwargs):
+        return super().retrieve(request, *args, **kwargs)
+
+    @idempotent
+    def create(self, request, *args, **kwargs):
+        return super().create(request, *args, **kwargs)
+
+    @transaction.atomic
+    def update(self, request, *args, **kwargs):
+        self.lock_cart()
+        return super().update(request, *args, **kwargs)
+
+    @transaction.atomic
+    def destroy(self, request, *args, **kwargs):
+        self.lock_cart()
+        return super().destroy(request, *args, **kwargs)
+
+    @action(detail=False, methods=['post'])
+    @idempotent
+    def bulk(self, request, *args, **kwargs):
+        serializer = ShoppingProductBulkSerializer(data=request.data, context=self.get_serializer_context())
+        serializer.is_valid(raise_exception=True)
+        shopping_products = serializer.save()
+        return Response(self.get_serializer(shopping_products, many=True).data, status=status.HTTP_201_CREATED)
+
+    @idempotent
     def checkout(self, request, *args, **kwargs):
+        if 'respond-async' in request.headers.get('Prefer', ''):
+            job = CheckoutJob.objects.create(user=request.user)
+            location = reverse('checkout-jobs-detail', kwargs={'pk': job.pk}, request=request)
+            return Response(CheckoutJobSerializer(job).data, status=status.HTTP_202_ACCEPTED,
+                            headers={'Location': location})
         response = super().list(request, args, kwargs)
         total_price, shopping_cart_products = self.get_products(request)
         order_serializer = OrderSerializer()
         order_serializer.create(request)
         response.data = dict(total_price=total_price, **response.data)
         return response
+
+
+class QuoteViewSet(viewsets.GenericViewSet):
+    """Prices and checks a list of {product, quantity} lines without reading or changing the cart."""
+    authentication_classes = (CachedJWTAuthentication,)
+    permission_classes = [IsAuthenticated, ]
+    serializer_class = QuoteSerializer
+
+    def create(self, request, *args, **kwargs):
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        return Response(serializer.quote())
+
+
+class OrderViewSet(viewsets.ReadOnlyModelViewSet):
+    """Order history of the user, newest first, with cursor pagination."""
+    authentication_classes = (CachedJWTAuthentication,)
+    permission_classes = [IsAuthenticated, ]
+    queryset = Order.objects.all()
+    serializer_class = OrderSerializer
+    pagination_class = OrderCursorPagination
+
+    def get_queryset(self):
+        return super().get_queryset().filter(user=self.request.user)
+
+    def paginate_queryset(self, queryset):
+        return Order.objects.prefetch_lines(super().paginate_queryset(queryset))
+
+    def get_object(self):
+        order = super().get_object()
+        Order.objects.prefetch_lines([order])
+        return order
+
+
+class CheckoutJobViewSet(mixins.RetrieveModelMixin, viewsets.GenericViewSet):
+    """Status of an asynchronous checkout, with its order once it is done."""
+    authentication_classes = (CachedJWTAuthentication,)
+    permission_classes = [IsAuthenticated, ]
+    queryset = CheckoutJob.objects.select_related('order')
+    serializer_class = CheckoutJobSerializer
+
+    def get_queryset(self):
+        return super().get_queryset().filter(user=self.request.user)
+
+    def get_object(self):
+        job = super().get_object()
+        Order.objects.prefetch_lines([job.order])
+        return job
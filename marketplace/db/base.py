@@ -0,0 +1,137 @@
+"""PostgreSQL backend adding connection health checks and an optional in-process connection pool.
+
+Extra DATABASES settings:
+
+- HEALTH_CHECKS: when True, a reused connection is checked with SELECT 1 before the first query of every request,
+  and replaced if the server dropped it.
+- POOL_SIZE: when above 0, connections are borrowed from a pool of at most POOL_SIZE connections shared by all the
+  threads of the process, and given back instead of being closed. Use it with CONN_MAX_AGE = 0.
+- POOL_TIMEOUT: seconds to wait for a free pooled connection before failing.
+"""
+import threading
+
+import psycopg2
+from django.db.backends.postgresql import base
+
+pools = {}
+pools_lock = threading.Lock()
+
+
+class ConnectionPool:
+    """Bounded pool of raw database connections, safe to share between threads."""
+
+    def __init__(self, connect, size, timeout):
+        self.connect = connect
+        self.size = size
+        self.timeout = timeout
+        self.checkouts = 0
+        self.waits = 0
+        self.timeouts = 0
+        self.connections = 0
+        self._idle = []
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(size)
+
+    def acquire(self):
+        """Returns a (connection, reused) pair, waiting up to `timeout` seconds for a free slot."""
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self.waits += 1
+            if not self._slots.acquire(timeout=self.timeout):
+                with self._lock:
+                    self.timeouts += 1
+                raise psycopg2.OperationalError(
+                    f'Connection pool exhausted: no connection released within {self.timeout} seconds.')
+        with self._lock:
+            self.checkouts += 1
+            connection = self._idle.pop() if self._idle else None
+        if connection is not None and not connection.closed:
+            return connection, True
+        try:
+            connection = self.connect()
+        except Exception:
+            self._slots.release()
+            raise
+        with self._lock:
+            self.connections += 1
+        return connection, False
+
+    def release(self, connection, discard=False):
+        try:
+            if not discard and not connection.closed:
+                if connection.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    connection.rollback()
+                with self._lock:
+                    self._idle.append(connection)
+                return
+            with self._lock:
+                self.connections -= 1
+            connection.close()
+        except psycopg2.Error:
+            with self._lock:
+                self.connections -= 1
+        finally:
+            self._slots.release()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': self.size,
+                'connections': self.connections,
+                'idle': len(self._idle),
+                'checkouts': self.checkouts,
+                'waits': self.waits,
+                'timeouts': self.timeouts,
+            }
+
+
+def get_pool(alias, settings_dict, connect):
+    key = (alias, settings_dict['HOST'], settings_dict['PORT'], settings_dict['NAME'])
+    with pools_lock:
+        if key not in pools:
+            pools[key] = ConnectionPool(connect, settings_dict['POOL_SIZE'], settings_dict.get('POOL_TIMEOUT', 10))
+        return pools[key]
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    health_check_done = False
+
+    @property
+    def pool(self):
+        if not self.settings_dict.get('POOL_SIZE'):
+            return None
+        return get_pool(self.alias, self.settings_dict, self._connect)
+
+    def _connect(self, conn_params=None):
+        return super().get_new_connection(conn_params or self.get_connection_params())
+
+    def get_new_connection(self, conn_params):
+        pool = self.pool
+        if pool is None:
+            connection = super().get_new_connection(conn_params)
+            self.health_check_done = True
+            return connection
+        connection, reused = pool.acquire()
+        self.health_check_done = not reused
+        self.isolation_level = connection.isolation_level
+        return connection
+
+    def _close(self):
+        pool = self.pool
+        if pool is None or self.connection is None:
+            return super()._close()
+        # A connection closed inside an atomic block stays referenced by this wrapper, so it can't be shared.
+        pool.release(self.connection, discard=self.in_atomic_block or self.errors_occurred)
+
+    def ensure_connection(self):
+        super().ensure_connection()
+        if self.settings_dict.get('HEALTH_CHECKS') and not self.health_check_done and not self.in_atomic_block:
+            self.health_check_done = True
+            if not self.is_usable():
+                self.close()
+                super().ensure_connection()
+
+    def close_if_unusable_or_obsolete(self):
+        super().close_if_unusable_or_obsolete()
+        # Called when requests start and finish: check a connection again before it serves the next request.
+        self.health_check_done = False
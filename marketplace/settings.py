@@ -45,6 +45,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'core.middleware.RequestMetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -74,21 +75,56 @@ TEMPLATES = [
 
 WSGI_APPLICATION = 'marketplace.wsgi.application'
 
+# Threads running the database work of the async views in core.async_views, when served by an ASGI server.
+ASYNC_DB_THREADS = int(os.environ.get('ASYNC_DB_THREADS', 16))
+
+# Share of the requests measured by core.middleware.RequestMetricsMiddleware, from 0 to 1.
+REQUEST_METRICS_SAMPLE_RATE = float(os.environ.get('REQUEST_METRICS_SAMPLE_RATE', 0.05))
+
+# Seconds an Idempotency-Key is remembered, see core.idempotency.
+IDEMPOTENCY_KEY_TTL = int(os.environ.get('IDEMPOTENCY_KEY_TTL', 24 * 3600))
+
+# Days without changes after which the sweep_carts command deletes a shopping cart.
+CART_IDLE_DAYS = int(os.environ.get('CART_IDLE_DAYS', 90))
+
 
 # Database
 # https://docs.djangoproject.com/en/3.2/ref/settings/#databases
+# marketplace.db is the PostgreSQL backend plus health checks and an optional connection pool,
+# see its docstring. Keep POSTGRES_CONN_MAX_AGE at 0 when POSTGRES_POOL_SIZE is set: connections
+# then go back to the pool at the end of every request.
 
 DATABASES = {
     'default': {
-        'ENGINE': 'django.db.backends.postgresql',
+        'ENGINE': 'marketplace.db',
         'NAME': os.environ.get('POSTGRES_DB'),
         'USER': os.environ.get('POSTGRES_USER'),
         'PASSWORD': os.environ.get('POSTGRES_PASSWORD'),
         'HOST': os.environ.get('POSTGRES_HOST'),
         'PORT': os.environ.get('POSTGRES_PORT'),
+        'CONN_MAX_AGE': int(os.environ.get('POSTGRES_CONN_MAX_AGE', 0)),
+        'HEALTH_CHECKS': os.environ.get('POSTGRES_HEALTH_CHECKS', 'true').lower() == 'true',
+        'POOL_SIZE': int(os.environ.get('POSTGRES_POOL_SIZE', 0)),
+        'POOL_TIMEOUT': float(os.environ.get('POSTGRES_POOL_TIMEOUT', 10)),
     }
 }
 
+# Cache
+# https://docs.djangoproject.com/en/3.2/topics/cache/
+# The local memory backend is per process; point CACHE_BACKEND to
+# django.core.cache.backends.filebased.FileBasedCache when running several workers,
+# so product cache invalidations reach all of them.
+
+CACHES = {
+    'default': {
+        'BACKEND': os.environ.get('CACHE_BACKEND', 'django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': os.environ.get('CACHE_LOCATION', 'marketplace'),
+    }
+}
+
+PRODUCT_CACHE_SIZE = int(os.environ.get('PRODUCT_CACHE_SIZE', 4096))
+PRODUCT_CACHE_TTL = int(os.environ.get('PRODUCT_CACHE_TTL', 30))
+
 # Password validation
 # https://docs.djangoproject.com/en/3.2/ref/settings/#auth-password-validators
 
@@ -135,7 +171,7 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 REST_FRAMEWORK = {
     'DEFAULT_FILTER_BACKENDS': ['django_filters.rest_framework.DjangoFilterBackend'],
     'DEFAULT_AUTHENTICATION_CLASSES': (
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
+        'core.authentication.CachedJWTAuthentication',
     ),
     'DEFAULT_PERMISSION_CLASSES': (
         'rest_framework.permissions.IsAuthenticated',
@@ -176,6 +212,11 @@ SIMPLE_JWT = {
     'SLIDING_TOKEN_REFRESH_LIFETIME': timedelta(days=1),
 }
 
+# Users kept in memory by core.authentication.CachedJWTAuthentication (SIZE, least recently used evicted first)
+# and the seconds each is kept (TTL); a TTL of 0 loads the user from the database on every request.
+JWT_USER_CACHE_SIZE = int(os.environ.get('JWT_USER_CACHE_SIZE', 10000))
+JWT_USER_CACHE_TTL = int(os.environ.get('JWT_USER_CACHE_TTL', 60))
+
 SWAGGER_SETTINGS = {
     'SECURITY_DEFINITIONS': {
         'api_key': {